@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+# Benchmark of the overhead of the harness itself: runs rd_collect.py,
+# rd_average.py and rd_plot.py on synthetic 10 bits Y4M clips, with stand-in
+# tools (shell scripts with canned output) instead of the encoder, the
+# decoder, ffmpeg and the metric tools, and reports the time of each stage
+# for several numbers of clips. Since the stand-ins do next to nothing, the
+# times are those of the probing, the process spawning, the parsing of the
+# outputs, the averaging and the plotting.
+
+import os
+import sys
+import stat
+import time
+import json
+import getopt
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+import y4m
+
+resolutions = [(176, 144), (352, 288), (640, 360)]
+
+stages = ["collect", "average", "plot"]
+
+# The metric tools print scores decreasing with the quality, read from the
+# name of the decoded video (<clip>-q<quality>.y4m)
+score_script = ('q=${q##*-q}\n'
+                'score=$((40 - ${q%%.*} / 2))\n'
+                'printf "0000000: %d.25\\n0000001: %d.75\\nTotal: %d.5\\n" '
+                '$score $score $score\n')
+
+# Stand-in tools, called like the real ones by rd_collect.py
+tools = {
+    # benchenc <quality> <source> <target>: a prefix of the source, shorter
+    # for higher qualities
+    "benchenc":
+    'size=$(wc -c < "$2")\n'
+    'head -c $((size * 10 / ($1 + 10))) "$2" > "$3"\n',
+    # benchdec <source> <target_dec>: the source itself
+    "benchdec": 'cp "$1" "$2"\n',
+    # ffmpeg -y -i <input> <args> <output>: a copy of the input
+    "ffmpeg":
+    'while [ $# -gt 1 ]; do\n'
+    '    if [ "$1" = "-i" ]; then input=$2; fi\n'
+    '    shift\n'
+    'done\n'
+    'cp "$input" "$1"\n',
+    "dump_ssim": 'eval q=\\${$#}\n' + score_script,
+    "dump_psnrhvs": 'eval q=\\${$#}\n' + score_script,
+    "dump_msssim": 'eval q=\\${$#}\n' + score_script,
+    "vmafossexec":
+    'q=$5\n'
+    'while [ $# -gt 1 ]; do\n'
+    '    if [ "$1" = "--log" ]; then\n'
+    '        echo \'{"frames": []}\' > "$2"\n'
+    '    fi\n'
+    '    shift\n'
+    'done\n'
+    'q=${q##*-q}\n'
+    'echo "VMAF score = $((100 - ${q%%.*} / 2)).5"\n'
+}
+
+recipes = {
+    "recipes": {
+        "bench": {
+            "quality_start": 10,
+            "quality_end": 50,
+            "quality_step": 10,
+            "threads": 1,
+            "encode_extension": "bin",
+            "decode_extension": "y4m",
+            "encode_cmd": "benchenc $quality $origy4m_10bits $target",
+            "decode_cmd": "benchdec $origy4m_10bits $target_dec"
+        }
+    }
+}
+
+# Runs rd_collect.py with its cache of prepared sources in the benchmark
+# folder, instead of the shared one
+collect_driver = ("import sys; sys.path.insert(0, {!r}); import rd_collect; "
+                  "rd_collect.cachedir = {!r}; rd_collect.main(sys.argv)")
+
+
+def write_tools(bin_folder):
+    os.makedirs(bin_folder, exist_ok=True)
+    for (name, script) in tools.items():
+        path = os.path.join(bin_folder, name)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\n" + script)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+# Writes clips random 10 bits 4:2:0 Y4M clips of frames frames each, cycling
+# through the resolutions
+def write_clips(folder, clips, frames, seed=0):
+    random = np.random.RandomState(seed)
+    os.makedirs(folder, exist_ok=True)
+    payloads = []
+    for (width, height) in resolutions:
+        header = {
+            'width': width,
+            'height': height,
+            'chroma': "420",
+            'bit_depth': 10
+        }
+        samples = y4m.frame_size(header) // 2
+        payloads.append(b"".join(
+            b"FRAME\n" + random.randint(0, 1024, samples).astype("<u2").tobytes()
+            for i in range(frames)))
+    for clip in range(clips):
+        (width, height) = resolutions[clip % len(resolutions)]
+        with open(os.path.join(folder, "clip%05d.y4m" % clip), "wb") as f:
+            f.write(b"YUV4MPEG2 W%d H%d F30:1 Ip A1:1 C420p10 XYSCSS=420P10\n" %
+                    (width, height))
+            f.write(payloads[clip % len(resolutions)])
+
+
+# The subset of the first clips clips, linked from the generated ones
+def write_subset(folder, clips_folder, clips):
+    os.makedirs(folder, exist_ok=True)
+    for clip in range(clips):
+        name = "clip%05d.y4m" % clip
+        os.link(os.path.join(clips_folder, name), os.path.join(folder, name))
+
+
+def run_stage(cmd, work, env):
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=work, env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, encoding="utf-8")
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        sys.stderr.write("Failure of {}:\n{}".format(" ".join(cmd),
+                                                     proc.stderr))
+        sys.exit(1)
+    return elapsed
+
+
+def main(argv):
+    clip_counts = [10, 100, 1000]
+    frames = 2
+    jobs = os.cpu_count()
+    selected = stages
+    folder = None
+
+    try:
+        [opts, args] = getopt.getopt(
+            argv[1:], "n:f:j:",
+            ["clips=", "frames=", "jobs=", "stages=", "keep="])
+        for (opt, value) in opts:
+            if opt in ("-n", "--clips"):
+                clip_counts = [int(count) for count in value.split(",")]
+            elif opt in ("-f", "--frames"):
+                frames = int(value)
+            elif opt in ("-j", "--jobs"):
+                jobs = int(value)
+            elif opt == "--stages":
+                selected = value.split(",")
+                if any(stage not in stages for stage in selected):
+                    raise getopt.GetoptError(
+                        "Unknown stage in {}".format(value))
+            elif opt == "--keep":
+                folder = os.path.normpath(value)
+    except (getopt.GetoptError, ValueError) as err:
+        print(err)
+        print("Usage: pipeline_bench.py [-n clips,...] [-f frames] [-j jobs] "
+              "[--stages collect,average,plot] [--keep folder]")
+        sys.exit(1)
+
+    work = folder or os.path.join(tempfile.mkdtemp(), "bench")
+    try:
+        os.makedirs(work, exist_ok=True)
+        write_tools(os.path.join(work, "bin"))
+        with open(os.path.join(work, "recipes.json"), "w") as f:
+            json.dump(recipes, f, indent=1)
+        env = dict(os.environ)
+        env['PATH'] = os.path.join(work, "bin") + os.pathsep + env['PATH']
+
+        start = time.perf_counter()
+        write_clips(os.path.join(work, "clips"), max(clip_counts), frames)
+        print("Wrote {} clips of {} frames in {:.2f} s.".format(
+            max(clip_counts), frames, time.perf_counter() - start))
+
+        timings = []
+        for clips in clip_counts:
+            subset = "bench%d" % clips
+            results = os.path.join("results", subset)
+            shutil.rmtree(os.path.join(work, results), ignore_errors=True)
+            shutil.rmtree(os.path.join(work, subset), ignore_errors=True)
+            write_subset(os.path.join(work, subset),
+                         os.path.join(work, "clips"), clips)
+
+            cmds = {
+                "collect": [
+                    sys.executable, "-c",
+                    collect_driver.format(root,
+                                          os.path.join(work, "cache") + "/"),
+                    "-j", str(jobs), "bench", subset, subset
+                ],
+                "average":
+                [sys.executable,
+                 os.path.join(root, "rd_average.py"), results],
+                "plot":
+                [sys.executable,
+                 os.path.join(root, "rd_plot.py"), results, "bench"]
+            }
+            timing = {}
+            for stage in selected:
+                timing[stage] = run_stage(cmds[stage], work, env)
+                print("{} clips, {}: {:.2f} s.".format(clips, stage,
+                                                       timing[stage]))
+            timings.append((clips, timing))
+
+        points = len(range(recipes['recipes']['bench']['quality_start'],
+                           recipes['recipes']['bench']['quality_end'],
+                           recipes['recipes']['bench']['quality_step']))
+        print("")
+        print("| clips | " + " | ".join(
+            "{} (s)".format(stage) for stage in selected) +
+              (" | collect per point (ms)" if "collect" in selected else "") +
+              " |")
+        print("|---" * (len(selected) + 1 + ("collect" in selected)) + "|")
+        for (clips, timing) in timings:
+            row = [str(clips)] + ["%.2f" % timing[stage] for stage in selected]
+            if "collect" in selected:
+                row.append("%.1f" % (timing["collect"] / (clips * points) *
+                                     1000))
+            print("| " + " | ".join(row) + " |")
+    finally:
+        if folder is None:
+            shutil.rmtree(os.path.dirname(work))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
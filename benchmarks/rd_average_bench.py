@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+# Benchmark of rd_average.py on a synthetic subset: writes the .out files of
+# a number of random clips at several resolutions, then times the averages of
+# the format.
+
+import os
+import sys
+import time
+import getopt
+import shutil
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+import rd_average
+import results_store
+
+resolutions = [(640, 360), (854, 480), (1280, 720), (1920, 1080)]
+
+
+# Writes the results files of clips random clips of points points each, for
+# the format fake of the subset folder
+def write_subset(folder, clips, points, seed=0):
+    random = np.random.RandomState(seed)
+    lossy_folder = os.path.join(folder, "fake", "lossy")
+    os.makedirs(lossy_folder, exist_ok=True)
+    for clip in range(clips):
+        (width, height) = resolutions[random.randint(len(resolutions))]
+        frames = random.randint(30, 600)
+        pixels = width * height * frames
+        orig_file_size = pixels * 3
+        lines = []
+        for point in range(points):
+            quality = 10 + point * 4
+            compressed_file_size = int(orig_file_size / (20 + point * 15) *
+                                       random.uniform(0.5, 2))
+            encode_time = random.uniform(1, 100)
+            decode_time = random.uniform(0.1, 10)
+            row = {
+                "file_name": "clip%05d" % clip,
+                "quality": quality,
+                "orig_file_size": orig_file_size,
+                "compressed_file_size": compressed_file_size,
+                "height": height,
+                "frames": frames,
+                "pixels": pixels,
+                "bpp": compressed_file_size * 8 / pixels,
+                "compression_ratio": orig_file_size / compressed_file_size,
+                "encode_time": encode_time,
+                "encode_fpm": frames / encode_time * 60,
+                "decode_time": decode_time,
+                "decode_fpm": frames / decode_time * 60,
+                "y_ssim_score": random.uniform(5, 25),
+                "rgb_ssim_score": random.uniform(5, 25),
+                "msssim_score": random.uniform(5, 25),
+                "psnrhvsm_score": random.uniform(20, 50),
+                "vmaf_score": random.uniform(20, 100),
+                "encode_user_time": encode_time * random.uniform(0.9, 4),
+                "encode_sys_time": encode_time * random.uniform(0, 0.1),
+                "encode_maxrss": random.randint(100000, 2000000),
+                "encode_time_spread": random.uniform(0, 0.1),
+                "decode_user_time": decode_time * random.uniform(0.9, 2),
+                "decode_sys_time": decode_time * random.uniform(0, 0.1),
+                "decode_maxrss": random.randint(10000, 200000),
+                "decode_time_spread": random.uniform(0, 0.1)
+            }
+            lines.append(":".join(
+                str(row[column]) if column in results_store.integer_columns
+                or column == "file_name" else "%f" % row[column]
+                for column in results_store.result_columns))
+        with open(os.path.join(lossy_folder, "clip%05d.fake.out" % clip),
+                  "w") as f:
+            f.write(":".join(results_store.result_columns) + "\n")
+            f.write("\n".join(lines) + "\n")
+
+
+def main(argv):
+    clips = 10000
+    points = 20
+    folder = None
+
+    try:
+        [opts, args] = getopt.getopt(argv[1:], "n:p:",
+                                     ["clips=", "points=", "keep="])
+    except getopt.GetoptError as err:
+        print(err)
+        print("Usage: rd_average_bench.py [-n clips] [-p points] [--keep folder]")
+        sys.exit(1)
+    for (opt, value) in opts:
+        if opt in ("-n", "--clips"):
+            clips = int(value)
+        elif opt in ("-p", "--points"):
+            points = int(value)
+        elif opt == "--keep":
+            folder = os.path.normpath(value)
+
+    subset = folder or os.path.join(tempfile.mkdtemp(), "bench")
+    try:
+        start = time.perf_counter()
+        write_subset(subset, clips, points)
+        print("Wrote {} clips of {} points in {:.2f} s.".format(
+            clips, points, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        rd_average.get_lossy_average((subset, "fake"))
+        print("rd_average: {:.2f} s.".format(time.perf_counter() - start))
+    finally:
+        if folder is None:
+            shutil.rmtree(os.path.dirname(subset))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
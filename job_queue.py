@@ -0,0 +1,203 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+# Job queue kept in a directory shared by several nodes (e.g. over NFS),
+# without any broker. Every job is a JSON file, which moves between the
+# directories of the queue by atomic renames:
+#
+#   pending/<job>.<threads>.json           waiting for a worker
+#   claimed/<job>.<threads>.<worker>.json  being processed by a worker
+#   done/<job>.<worker>.json               result, collected by the coordinator
+#
+# Of the workers renaming the same pending job, only one succeeds. A worker
+# keeps the modification time of its claimed jobs fresh; the coordinator
+# puts back in pending the claimed jobs that have not been refreshed for
+# longer than the lease, those of a dead worker. The times are compared with
+# the clock of the file server, read from a file touched for that purpose.
+
+import os
+import json
+import socket
+import shutil
+
+queue_dirs = ["pending", "claimed", "done", "tmp"]
+
+
+def get_worker_id():
+    return "%s-%d" % (socket.gethostname().replace(".", "_"), os.getpid())
+
+
+# Writes a JSON file, visible only once complete
+def write_json(queue_dir, path, data):
+    tmp_file = os.path.join(queue_dir, "tmp", "%s.%s" % (os.path.basename(path),
+                                                        get_worker_id()))
+    with open(tmp_file, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_file, path)
+
+
+# Creates an empty queue, with the description of the run shared by all its
+# jobs (settings, lease, ...)
+def create_queue(queue_dir, description):
+    for name in queue_dirs + ["closed"]:
+        path = os.path.join(queue_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    for name in queue_dirs:
+        os.makedirs(os.path.join(queue_dir, name))
+    write_json(queue_dir, os.path.join(queue_dir, "queue.json"), description)
+
+
+def read_queue(queue_dir):
+    try:
+        with open(os.path.join(queue_dir, "queue.json")) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+# The coordinator closes the queue when it is done, which stops the workers
+def close_queue(queue_dir):
+    open(os.path.join(queue_dir, "closed"), "w").close()
+
+
+def is_closed(queue_dir):
+    return os.path.exists(os.path.join(queue_dir, "closed"))
+
+
+def server_time(queue_dir):
+    path = os.path.join(queue_dir, "clock")
+    with open(path, "w"):
+        pass
+    return os.stat(path).st_mtime
+
+
+def publish(queue_dir, job_id, threads, args):
+    write_json(queue_dir,
+               os.path.join(queue_dir, "pending",
+                            "%s.%d.json" % (job_id, threads)), args)
+
+
+# Returns the (name, threads) of the pending jobs, in order
+def list_pending(queue_dir):
+    jobs = []
+    for name in sorted(os.listdir(os.path.join(queue_dir, "pending"))):
+        parts = name.split(".")
+        if len(parts) == 3:
+            jobs.append((name, int(parts[1])))
+    return jobs
+
+
+# Claims a pending job for the worker, and returns the path of the claimed
+# job and its arguments, or None if another worker claimed it first. The
+# worker id has to be unique for each claim.
+def claim(queue_dir, name, worker):
+    path = os.path.join(queue_dir, "claimed",
+                        name[:-len(".json")] + "." + worker + ".json")
+    try:
+        os.rename(os.path.join(queue_dir, "pending", name), path)
+    except FileNotFoundError:
+        return None
+    # The lease starts with the claim, not with the publication
+    os.utime(path)
+    with open(path) as f:
+        return (path, json.load(f))
+
+
+def heartbeat(paths):
+    for path in paths:
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Requeued after missing its lease, the result will be ignored
+            # if the job is done again by another worker
+            pass
+
+
+# Publishes the result of a claimed job, or the error it failed with
+def complete(queue_dir, path, result=None, error=None):
+    (job_id, threads, worker) = os.path.basename(path).split(".")[:3]
+    write_json(queue_dir,
+               os.path.join(queue_dir, "done", job_id + "." + worker + ".json"),
+               {"result": result, "error": error})
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Puts back in pending the claimed jobs whose lease expired, and returns
+# their ids
+def requeue_expired(queue_dir, lease):
+    now = server_time(queue_dir)
+    requeued = []
+    claimed_dir = os.path.join(queue_dir, "claimed")
+    for name in os.listdir(claimed_dir):
+        path = os.path.join(claimed_dir, name)
+        try:
+            if os.stat(path).st_mtime > now - lease:
+                continue
+            (job_id, threads) = name.split(".")[:2]
+            os.rename(path,
+                      os.path.join(queue_dir, "pending",
+                                   job_id + "." + threads + ".json"))
+        except FileNotFoundError:
+            continue
+        requeued.append(job_id)
+    return requeued
+
+
+# Returns the (job id, result, error) of the jobs done since the last call
+def collect(queue_dir):
+    results = []
+    done_dir = os.path.join(queue_dir, "done")
+    for name in sorted(os.listdir(done_dir)):
+        path = os.path.join(done_dir, name)
+        with open(path) as f:
+            done = json.load(f)
+        os.remove(path)
+        results.append((name.split(".")[0], done["result"], done["error"]))
+    return results
+
+
+# Removes the copies left of a job done, e.g. requeued while its first
+# worker was only late
+def discard(queue_dir, job_id):
+    for name in ("pending", "claimed"):
+        directory = os.path.join(queue_dir, name)
+        for entry in os.listdir(directory):
+            if entry.split(".")[0] == job_id:
+                try:
+                    os.remove(os.path.join(directory, entry))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,241 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+# In-process implementation of the luma metrics, as an alternative to the
+# dump_* tools. The Y4M files are memory-mapped and scored a batch of frames
+# at a time. The scores are in dB, like the ones of the daala tools.
+#
+# The statistics of the reference that SSIM needs (local means and second
+# moments at every scale) do not depend on the distorted video, so they can
+# be computed once per clip with reference_stats() and reused for every
+# quality point.
+
+import numpy as np
+import y4m
+
+# Number of frames scored at once, to bound the memory used
+batch_frames = 4
+
+# Gaussian window of the SSIM
+window_size = 11
+window_sigma = 1.5
+
+# Weights of the five scales of MS-SSIM
+msssim_weights = [0.0448, 0.2856, 0.3001, 0.2363, 0.1333]
+
+C1 = 0.01**2
+C2 = 0.03**2
+
+
+def to_db(score):
+    if score >= 1:
+        return float("inf")
+    return -10 * np.log10(1 - score)
+
+
+def frames_to_db(scores):
+    with np.errstate(divide="ignore"):
+        return -10 * np.log10(1 - np.minimum(scores, 1))
+
+
+def peak(header):
+    return (1 << header['bit_depth']) - 1
+
+
+def gaussian_window():
+    x = np.arange(window_size, dtype=np.float64) - (window_size - 1) / 2
+    window = np.exp(-x**2 / (2 * window_sigma**2))
+    return (window / window.sum()).astype(np.float32)
+
+
+# Separable Gaussian filter over the last two axes, keeping only the fully
+# covered samples
+def blur(planes):
+    window = gaussian_window()
+    width = planes.shape[-1] - window_size + 1
+    rows = window[0] * planes[..., 0:width]
+    for i in range(1, window_size):
+        rows += window[i] * planes[..., i:i + width]
+    height = planes.shape[-2] - window_size + 1
+    out = window[0] * rows[..., 0:height, :]
+    for i in range(1, window_size):
+        out += window[i] * rows[..., i:i + height, :]
+    return out
+
+
+# 2x2 average, dropping the odd last row and column
+def downsample(planes):
+    height = planes.shape[-2] // 2 * 2
+    width = planes.shape[-1] // 2 * 2
+    planes = planes[..., :height, :width]
+    return (planes[..., 0::2, 0::2] + planes[..., 1::2, 0::2] +
+            planes[..., 0::2, 1::2] + planes[..., 1::2, 1::2]) / 4
+
+
+def normalize(planes, header):
+    return planes.astype(np.float32) / peak(header)
+
+
+def batches(frames):
+    for start in range(0, frames, batch_frames):
+        yield slice(start, min(start + batch_frames, frames))
+
+
+def check_headers(ref_header, dist_header):
+    for key in ('width', 'height', 'frames'):
+        if ref_header[key] != dist_header[key]:
+            raise ValueError("The videos differ in {}: {} != {}".format(
+                key, ref_header[key], dist_header[key]))
+
+
+# Local means and second moments of the reference at the given number of
+# scales, as a list with one (frames, 2, height, width) array per scale.
+# out, if given, is the list of arrays to fill.
+def reference_stats(ref_path, scales, out=None):
+    header = y4m.probe(ref_path)
+    ref = y4m.luma_planes(ref_path, header)
+    if out is None:
+        out = [None] * scales
+    for frames in batches(header['frames']):
+        x = normalize(ref[frames], header)
+        for scale in range(scales):
+            if scale > 0:
+                x = downsample(x)
+            stats = np.stack([blur(x), blur(x * x)], axis=1)
+            if out[scale] is None:
+                out[scale] = np.empty(
+                    (header['frames'], ) + stats.shape[1:], dtype=np.float32)
+            out[scale][frames] = stats
+    return out
+
+
+# Whether the frames are large enough for the SSIM window at every scale
+def fits(header, scales):
+    return min(header['width'], header['height']) >> (scales - 1) >= \
+        window_size
+
+
+def check_size(header, scales):
+    if not fits(header, scales):
+        raise ValueError("The video is too small for {} scales".format(scales))
+
+
+# Shapes of the arrays returned by reference_stats()
+def stats_shapes(header, scales):
+    check_size(header, scales)
+    (height, width) = (header['height'], header['width'])
+    shapes = []
+    for scale in range(scales):
+        if scale > 0:
+            (height, width) = (height // 2, width // 2)
+        shapes.append((header['frames'], 2, height - window_size + 1,
+                       width - window_size + 1))
+    return shapes
+
+
+def stats_views(data, shapes):
+    views = []
+    offset = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        views.append(data[offset:offset + size].reshape(shape))
+        offset += size
+    return views
+
+
+# Saves the reference statistics at every scale to a single .npy file, that
+# read_reference_stats() maps back without loading it.
+def write_reference_stats(ref_path, scales, path):
+    shapes = stats_shapes(y4m.probe(ref_path), scales)
+    data = np.lib.format.open_memmap(
+        path,
+        mode="w+",
+        dtype=np.float32,
+        shape=(sum(int(np.prod(shape)) for shape in shapes), ))
+    reference_stats(ref_path, scales, stats_views(data, shapes))
+    data.flush()
+
+
+def read_reference_stats(ref_path, scales, path):
+    shapes = stats_shapes(y4m.probe(ref_path), scales)
+    return stats_views(np.load(path, mmap_mode="r"), shapes)
+
+
+# Returns the per-frame luminance and contrast-structure terms of SSIM at
+# each scale, as two (scales, frames) arrays.
+def ssim_terms(ref_path, dist_path, scales, stats=None):
+    ref_header = y4m.probe(ref_path)
+    dist_header = y4m.probe(dist_path)
+    check_headers(ref_header, dist_header)
+    check_size(ref_header, scales)
+    ref = y4m.luma_planes(ref_path, ref_header)
+    dist = y4m.luma_planes(dist_path, dist_header)
+
+    luminance = np.empty((scales, ref_header['frames']))
+    contrast = np.empty((scales, ref_header['frames']))
+    for frames in batches(ref_header['frames']):
+        x = normalize(ref[frames], ref_header)
+        y = normalize(dist[frames], dist_header)
+        for scale in range(scales):
+            if scale > 0:
+                x = downsample(x)
+                y = downsample(y)
+            if stats is None:
+                mu_x = blur(x)
+                xx = blur(x * x)
+            else:
+                mu_x = stats[scale][frames, 0]
+                xx = stats[scale][frames, 1]
+            mu_y = blur(y)
+            yy = blur(y * y)
+            xy = blur(x * y)
+
+            sigma_x = xx - mu_x * mu_x
+            sigma_y = yy - mu_y * mu_y
+            sigma_xy = xy - mu_x * mu_y
+            l = (2 * mu_x * mu_y + C1) / (mu_x * mu_x + mu_y * mu_y + C1)
+            cs = (2 * sigma_xy + C2) / (sigma_x + sigma_y + C2)
+            luminance[scale, frames] = (l * cs).mean(axis=(-2, -1))
+            contrast[scale, frames] = cs.mean(axis=(-2, -1))
+    return (luminance, contrast)
+
+
+def y_ssim_frames(ref_path, dist_path, stats=None):
+    (ssim, contrast) = ssim_terms(ref_path, dist_path, 1, stats)
+    return ssim[0]
+
+
+def msssim_frames(ref_path, dist_path, stats=None):
+    scales = len(msssim_weights)
+    (ssim, contrast) = ssim_terms(ref_path, dist_path, scales, stats)
+    weights = np.array(msssim_weights)[:, np.newaxis]
+    # Negative terms only happen for anti-correlated content
+    contrast = np.maximum(contrast, 0)
+    ssim = np.maximum(ssim, 0)
+    return np.prod(contrast[:-1]**weights[:-1], axis=0) * ssim[-1]**weights[-1]
@@ -28,129 +28,423 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import io
 import os
+import re
 import sys
 import glob
+import json
+import getopt
+import itertools
 import numpy as np
 import pandas as pd
+import results_store
 from multiprocessing import Pool
 
 
-def get_lossy_average(args):
-    [path, format] = args
+# Columns of the per-clip results used for the averages
+input_columns = [
+    "file_name", "quality", "orig_file_size", "compressed_file_size",
+    "height", "frames", "pixels", "encode_fpm", "decode_fpm", "y_ssim_score",
+    "rgb_ssim_score", "msssim_score", "psnrhvsm_score", "vmaf_score",
+    "encode_user_time", "encode_sys_time", "encode_maxrss",
+    "encode_time_spread", "decode_user_time", "decode_sys_time",
+    "decode_maxrss", "decode_time_spread"
+]
+
+
+# Columns averaged with the number of pixels of the clips as weights
+weighted_columns = [
+    "encode_fpm", "decode_fpm", "y_ssim_score", "rgb_ssim_score",
+    "msssim_score", "psnrhvsm_score", "vmaf_score", "encode_cpu_fpm",
+    "decode_cpu_fpm", "encode_time_spread", "decode_time_spread"
+]
+
+# Statistics of the per-frame scores of each point, when they were captured:
+# the 5th percentile, and the harmonic mean
+frame_columns = [
+    stat + "_" + metric + "_score" for metric in results_store.frame_metrics
+    for stat in ("p5", "hmean")
+]
+weighted_columns += frame_columns
+
+# Columns of which the maximum is kept
+max_columns = ["encode_maxrss", "decode_maxrss"]
+
+final_columns = [
+    "quality", "avg_bpp", "avg_compression_ratio", "avg_space_saving"
+] + ["wavg_" + column for column in weighted_columns
+     ] + ["max_" + column for column in max_columns]
+
+# Sums of each resolution and point from which the averages are computed,
+# the weighted columns being summed multiplied by the number of pixels, and
+# the maximum of the max_columns
+sum_columns = [
+    "clips", "quality", "orig_file_size", "compressed_file_size", "pixels"
+] + weighted_columns + max_columns
+
+
+def get_manifest_file(path, format):
+    return path + "/" + os.path.basename(
+        path) + "." + format + ".manifest.json"
+
+
+def get_average_file(path, format, resolution):
+    return path + "/" + os.path.basename(
+        path) + "." + format + "." + str(resolution) + ".lossy.out"
+
+
+# Returns the name, size and modification time of the per-frame scores files
+# of each clip of a format, by the name of the clip.
+def get_frames_signatures(path, format):
+    signatures = {}
+    pattern = re.compile(r"^(.*)\." + re.escape(format) + r"\.[-\d.]+\.npy$")
+    for f in sorted(glob.glob(path + "/" + format + "/frames/*.npy")):
+        match = pattern.match(os.path.basename(f))
+        if match is None:
+            continue
+        stat = os.stat(f)
+        signatures.setdefault(match.group(1), []).append(
+            [os.path.basename(f), stat.st_size, stat.st_mtime_ns])
+    return signatures
 
-    if not glob.glob(path + "/" + format + "/lossy/*.out"):
-        print("Lossy results files could not be found for format {}.".format(
-            format))
-        return
 
+# Returns where the results of a format are read from, the results store or
+# the .out files, and the signature of the results of each clip: the version
+# of its results in the store, or the size and modification time of its
+# .out file, followed by those of its per-frame scores files. The .out files
+# missing from the store are added to it first.
+def get_inputs(path, format):
+    frames = get_frames_signatures(path, format)
+    store_file = results_store.get_store_file(path)
+    if results_store.has_results(store_file, format):
+        results_store.import_missing(path, format)
+        return ("store", {
+            file_name: [version] + frames.get(file_name, [])
+            for (file_name, version) in results_store.get_clip_versions(
+                store_file, format).items()
+        })
+
+    inputs = {}
+    for f in glob.glob(path + "/" + format + "/lossy/*.out"):
+        stat = os.stat(f)
+        clip = os.path.basename(f)[:-len("." + format + ".out")]
+        inputs[os.path.basename(f)] = [stat.st_size, stat.st_mtime_ns
+                                       ] + frames.get(clip, [])
+    return ("files", inputs)
+
+
+# Returns the results of the given clips of a format (all of them by
+# default) in a single DataFrame, with the index of each line in the results
+# of its clip as point.
+def load_results(path, format, source, clips=None):
+    if source == "store":
+        return results_store.read_results(
+            results_store.get_store_file(path), format, input_columns,
+            file_names=clips)
+
+    files = glob.glob(path + "/" + format + "/lossy/*.out")
+    if clips is not None:
+        clips = set(clips)
+        files = [f for f in files if os.path.basename(f) in clips]
+
+    # The lines of the files with the same header are parsed at once
+    lines = {}
+    for f in files:
+        with open(f) as results:
+            header = results.readline()
+            lines.setdefault(header, []).append(results.read().splitlines())
+
+    # The columns missing from the files written before they were recorded,
+    # like the CPU times, are NaN
     rawdata = []
-    columns = [
-        "file_name", "quality", "orig_file_size", "compressed_file_size",
-        "height", "frames", "pixels", "bpp", "compression_ratio", 
-        "encode_time", "encode_fpm", "decode_time", "decode_fpm"
-        "y_ssim_score", "rgb_ssim_score", "msssim_score", "psnrhvsm_score",
-        "vmaf_score"
-    ]
-    final_columns = [
-        "quality", "avg_bpp", "avg_compression_ratio", "avg_space_saving",
-        "wavg_encode_fpm", "wavg_decode_fpm", "wavg_y_ssim_score",
-        "wavg_rgb_ssim_score", "wavg_msssim_score", "wavg_psnrhvsm_score",
-        "wavg_vmaf_score"
-    ]
-
-    data_path = path + "/" + format + "/lossy/"
-
-    for f in glob.glob(data_path + "*.out"):
-        rawdata.append(pd.read_csv(f, sep=":"))
-
-    quality_length = len(rawdata[0].index)
-
-    resolution_list = []
-    for data in rawdata:
-        resolution_list = resolution_list + data["height"][data.index == 1].tolist()
-    resolution_list = list(set(resolution_list)) + ["any"]
-
-    for resolution in resolution_list:
-        
-        merged_data = []
-        final_data = pd.DataFrame(columns=final_columns)
-
-        for i in range(quality_length):
-            merged_data.insert(i, pd.DataFrame(columns=columns))
-
-            for data in rawdata:
-                if resolution == "any":
-                    merged_data[i] = merged_data[i].append(data.iloc[[i]], sort=True)
-                else:
-                    merged_data[i] = merged_data[i].append(data[(data.index == i) & (data["height"] == resolution)], sort=True)
-
-            merged_data[i].sort_values("file_name", ascending=True, inplace=True)
-
-            quality = np.mean(merged_data[i]["quality"])
-            sum_orig_file_size = np.sum(merged_data[i]["orig_file_size"])
-            sum_compressed_file_size = np.sum(
-                merged_data[i]["compressed_file_size"])
-            sum_pixels = np.sum(merged_data[i]["pixels"])
-            avg_bpp = sum_compressed_file_size * 8 / sum_pixels
-            avg_compression_ratio = sum_orig_file_size / sum_compressed_file_size
-            avg_space_saving = 1 - (1 / avg_compression_ratio)
-            wavg_encode_fpm = np.average(
-                merged_data[i]["encode_fpm"], weights=merged_data[i]["pixels"])
-            wavg_decode_fpm = np.average(
-                merged_data[i]["decode_fpm"], weights=merged_data[i]["pixels"])
-            wavg_y_ssim_score = np.average(
-                merged_data[i]["y_ssim_score"], weights=merged_data[i]["pixels"])
-            wavg_rgb_ssim_score = np.average(
-                merged_data[i]["rgb_ssim_score"], weights=merged_data[i]["pixels"])
-            wavg_msssim_score = np.average(
-                merged_data[i]["msssim_score"], weights=merged_data[i]["pixels"])
-            wavg_psnrhvsm_score = np.average(
-                merged_data[i]["psnrhvsm_score"], weights=merged_data[i]["pixels"])
-            wavg_vmaf_score = np.average(
-                merged_data[i]["vmaf_score"], weights=merged_data[i]["pixels"])
-
-            final_data.loc[i] = [
-                quality, avg_bpp, avg_compression_ratio, avg_space_saving,
-                wavg_encode_fpm, wavg_decode_fpm, wavg_y_ssim_score,
-                wavg_rgb_ssim_score, wavg_msssim_score, wavg_psnrhvsm_score,
-                wavg_vmaf_score
+    for header, files in lines.items():
+        data = pd.read_csv(
+            io.StringIO(header + "\n".join(itertools.chain(*files))),
+            sep=":").reindex(columns=input_columns)
+        data["point"] = np.concatenate(
+            [np.arange(len(file_lines)) for file_lines in files])
+        rawdata.append(data)
+    if not rawdata:
+        return pd.DataFrame(columns=input_columns + ["point"])
+    return pd.concat(rawdata, ignore_index=True, sort=False)
+
+
+# Returns the first row of each group of rows with the same keys, the rows
+# being sorted by keys
+def get_group_starts(keys):
+    changes = np.zeros(len(keys[0]), dtype=bool)
+    changes[0] = True
+    for key in keys:
+        changes[1:] |= key[1:] != key[:-1]
+    return np.append(np.flatnonzero(changes), len(changes))
+
+
+# Returns the sum_columns of each point of each resolution and of any
+# resolution, as {resolution: {point: sums}}. A weighted column is NaN when
+# a clip of the point lacks it, and the maximum is the one of the clips
+# that have it.
+def get_sums(data):
+    sums = {}
+    # The points pruned by a stop rule of rd_collect.py were not encoded, and
+    # each point is averaged over the clips that measured it
+    pruned = data["compressed_file_size"].isna()
+    if pruned.any():
+        data = data[~pruned].copy()
+    if data.empty:
+        return sums
+
+    # Frames per minute of CPU time, user and system
+    for stage in ("encode", "decode"):
+        data[stage + "_cpu_fpm"] = data["frames"] / (
+            data[stage + "_user_time"] + data[stage + "_sys_time"]) * 60
+
+    columns = {
+        column: data[column].values
+        for column in ["quality", "orig_file_size", "compressed_file_size",
+                       "pixels"] + max_columns
+    }
+    for column in weighted_columns:
+        columns[column] = np.multiply(data[column].values, data["pixels"].values)
+    file_names = data["file_name"].values
+    heights = data["height"].values
+    points = data["point"].values
+
+    # The rows of each resolution, then those of any resolution, sorted by
+    # point and clip so that every group is a contiguous range of rows
+    order = np.concatenate([
+        np.lexsort((file_names, points, heights)),
+        np.lexsort((file_names, points)) + len(points)
+    ])
+    buckets = np.concatenate(
+        [heights.astype(str), np.full(len(heights), "any")])[order]
+    points = np.concatenate([points, points])[order]
+    columns = {
+        column: np.concatenate([values, values])[order]
+        for (column, values) in columns.items()
+    }
+
+    # The weighted columns are summed one clip after the other in the order
+    # of their names, so that the averages do not depend on how NumPy splits
+    # the sums
+    starts = get_group_starts([buckets, points])
+    for (start, end) in zip(starts[:-1], starts[1:]):
+        sums.setdefault(str(buckets[start]), {})[int(points[start])] = [
+            int(end - start)
+        ] + [
+            np.sum(columns[column][start:end]).item()
+            for column in ["quality", "orig_file_size", "compressed_file_size",
+                           "pixels"]
+        ] + [
+            np.cumsum(columns[column][start:end])[-1].item()
+            for column in weighted_columns
+        ] + [
+            np.fmax.reduce(columns[column][start:end]).item()
+            for column in max_columns
+        ]
+    return sums
+
+
+# Adds the sums of new clips to sums
+def add_sums(sums, new_sums):
+    maxima = len(sum_columns) - len(max_columns)
+    for resolution, points in new_sums.items():
+        for point, new in points.items():
+            old = sums.setdefault(resolution, {}).get(point)
+            if old is None:
+                sums[resolution][point] = new
+                continue
+            sums[resolution][point] = [
+                a + b for (a, b) in zip(old[:maxima], new[:maxima])
+            ] + [
+                np.fmax(a, b).item()
+                for (a, b) in zip(old[maxima:], new[maxima:])
             ]
-                
-        results_file = path + "/" + os.path.basename(
-            path) + "." + format + "." + str(resolution) + ".lossy.out"
+
+
+# Returns the final_columns of a point from its sums
+def get_averages(point_sums):
+    sums = dict(zip(sum_columns, point_sums))
+    avg_compression_ratio = sums["orig_file_size"] / sums[
+        "compressed_file_size"]
+    return [
+        sums["quality"] / sums["clips"],
+        sums["compressed_file_size"] * 8 / sums["pixels"],
+        avg_compression_ratio, 1 - (1 / avg_compression_ratio)
+    ] + [sums[column] / sums["pixels"] for column in weighted_columns
+         ] + [sums[column] for column in max_columns]
+
+
+# Adds the frame_columns of each point to its results, from its per-frame
+# scores. The scores of one point at a time are mapped, and the statistics
+# are NaN for the points without per-frame scores.
+def add_frame_stats(path, format, data):
+    stats = np.full((len(data), len(frame_columns)), np.nan)
+    if os.path.isdir(os.path.join(path, format, "frames")):
+        for (i, (file_name, quality)) in enumerate(
+                zip(data["file_name"], data["quality"])):
+            frames_file = results_store.get_frames_file(
+                path, format, str(file_name), quality)
+            if not os.path.isfile(frames_file):
+                continue
+            frames = results_store.read_frames(frames_file).astype(np.float64)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                stats[i, 0::2] = np.nanpercentile(frames, 5, axis=1)
+                # Harmonic mean of score + 1, so that scores of 0 are allowed
+                stats[i, 1::2] = 1 / np.nanmean(1 / (frames + 1), axis=1) - 1
+    for (i, column) in enumerate(frame_columns):
+        data[column] = stats[:, i]
+    return data
+
+
+def write_averages(path, format, sums, resolutions):
+    for resolution in resolutions:
+        results_file = get_average_file(path, format, resolution)
+        points = sums[resolution]
+        final_data = pd.DataFrame(
+            [get_averages(points[point]) for point in sorted(points)],
+            columns=final_columns,
+            dtype=np.float64)
+        # The statistics of the per-frame scores are only written if captured
+        final_data = final_data.drop(columns=[
+            "wavg_" + column for column in frame_columns
+            if final_data["wavg_" + column].isna().all()
+        ])
         final_data.to_csv(results_file, sep=":", index=False)
         print("Lossy results file for format {} successfully saved to {}.".format(
             format, results_file))
 
 
+# The manifest of a format keeps the signatures of the results averaged, and
+# the sums of each resolution and point
+def read_manifest(path, format):
+    try:
+        with open(get_manifest_file(path, format)) as f:
+            manifest = json.load(f)
+        manifest["sums"] = {
+            resolution: {int(point): sums
+                         for (point, sums) in points.items()}
+            for (resolution, points) in manifest["sums"].items()
+        }
+        return manifest
+    except (OSError, ValueError, KeyError, AttributeError):
+        return None
+
+
+def write_manifest(path, format, source, inputs, sums):
+    manifest_file = get_manifest_file(path, format)
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({
+            "source": source,
+            "columns": sum_columns,
+            "inputs": inputs,
+            "sums": sums
+        }, f)
+    os.replace(tmp_file, manifest_file)
+
+
+def get_lossy_average(args):
+    [path, format] = args
+
+    (source, inputs) = get_inputs(path, format)
+    sums = get_sums(
+        add_frame_stats(path, format, load_results(path, format, source)))
+    if not sums:
+        print("Lossy results files could not be found for format {}.".format(
+            format))
+        return
+
+    write_averages(path, format, sums, sums)
+    write_manifest(path, format, source, inputs, sums)
+
+
+# Updates the averages of a format from its manifest: nothing is computed if
+# its results did not change, and the sums of the new clips are added to
+# those of the manifest if clips were only added. Otherwise, the averages are
+# computed again from all the results.
+def update_lossy_average(args):
+    [path, format] = args
+
+    (source, inputs) = get_inputs(path, format)
+    manifest = read_manifest(path, format)
+    if (manifest is None or manifest["source"] != source
+            or manifest.get("columns") != sum_columns or any(
+            inputs.get(clip) != signature
+            for (clip, signature) in manifest["inputs"].items())):
+        get_lossy_average(args)
+        return
+
+    sums = manifest["sums"]
+    new_clips = [clip for clip in inputs if clip not in manifest["inputs"]]
+    if not new_clips:
+        missing = [
+            resolution for resolution in sums if not os.path.isfile(
+                get_average_file(path, format, resolution))
+        ]
+        if missing:
+            write_averages(path, format, sums, missing)
+        else:
+            print("Lossy results files for format {} are up to date.".format(
+                format))
+        return
+
+    new_sums = get_sums(
+        add_frame_stats(path, format,
+                        load_results(path, format, source, new_clips)))
+    add_sums(sums, new_sums)
+    write_averages(path, format, sums, new_sums)
+    write_manifest(path, format, source, inputs, sums)
+
+
 def main(argv):
     if sys.version_info[0] < 3 and sys.version_info[1] < 5:
         raise Exception("Python 3.5 or a more recent version is required.")
 
-    if len(argv) < 1 or len(argv) > 2:
+    full = False
+    try:
+        opts, args = getopt.getopt(argv[1:], "", ["full"])
+        for opt, value in opts:
+            if opt == "--full":
+                full = True
+    except getopt.GetoptError:
+        args = []
+
+    if len(args) != 1:
         print(
             "rd_average.py: Calculate a per format weighted averages of the results files generated by rd_collect.py"
         )
         print(
             "Arg 1: Path to the results of a subset generated by rd_collect.py")
         print("       For ex: rd_average.py \"results/subset1\"")
+        print("Options:")
+        print("  --full: compute again the averages of every format, even if their results did not change")
         return
 
-    results_folder = os.path.normpath(argv[1])
-    available_formats = next(os.walk(results_folder))[1]
+    results_folder = os.path.normpath(args[0])
+    store_file = results_store.get_store_file(results_folder)
 
     # Check is there is actually results files in the path provided
-    if (not os.path.isdir(results_folder) or not available_formats
-            or not glob.glob(results_folder + "/**/*.out", recursive=True)):
+    if (not os.path.isdir(results_folder)
+            or not (os.path.isfile(store_file) or glob.glob(
+                results_folder + "/**/*.out", recursive=True))):
+        print(
+            "Could not find all results file. Please make sure the path provided is correct."
+        )
+        return
+
+    available_formats = next(os.walk(results_folder))[1]
+    if os.path.isfile(store_file):
+        available_formats = sorted(
+            set(available_formats + results_store.get_formats(store_file)))
+    if not available_formats:
         print(
             "Could not find all results file. Please make sure the path provided is correct."
         )
         return
 
-    Pool().map(get_lossy_average,
-               [(results_folder, format)
-                for format in next(os.walk(results_folder))[1]])
+    Pool().map(get_lossy_average if full else update_lossy_average,
+               [(results_folder, format) for format in available_formats])
 
 
 if __name__ == "__main__":
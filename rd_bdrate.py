@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import glob
+import numpy as np
+import pandas as pd
+import six
+import pytablewriter
+
+# Quality metrics of the averages generated by rd_average.py
+metrics = [("y-ssim", "wavg_y_ssim_score"), ("rgb-ssim", "wavg_rgb_ssim_score"),
+           ("ms-ssim", "wavg_msssim_score"),
+           ("psnr-hvs-m", "wavg_psnrhvsm_score"), ("vmaf", "wavg_vmaf_score")]
+
+# Degree of the polynomials fitted to the curves
+fit_degree = 3
+
+
+def get_average_file(path, format, resolution):
+    return path + "/" + os.path.basename(
+        path) + "." + format + "." + str(resolution) + ".lossy.out"
+
+
+# Fits y in function of x for every curve, and returns the integrals of the
+# fitted polynomials, highest degree first, with the range of x of each curve
+def fit_curves(curves):
+    integrals = np.zeros((len(curves), fit_degree + 2))
+    lows = np.full(len(curves), np.nan)
+    highs = np.full(len(curves), np.nan)
+    for i, (x, y) in enumerate(curves):
+        if len(x) < 2:
+            continue
+        coefficients = np.polyint(
+            np.polyfit(x, y, min(fit_degree, len(x) - 1)))
+        integrals[i, fit_degree + 2 - len(coefficients):] = coefficients
+        lows[i] = np.min(x)
+        highs[i] = np.max(x)
+    return (integrals, lows, highs)
+
+
+# Returns the average difference of y between every pair of curves over the
+# range of x they share, as a matrix of the curve tested (column) against
+# the anchor (row). The polynomial of each curve is only fitted once.
+def get_average_differences(curves):
+    (integrals, lows, highs) = fit_curves(curves)
+    low = np.maximum.outer(lows, lows)
+    high = np.minimum.outer(highs, highs)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        powers = np.arange(fit_degree + 1, -1, -1)
+        spans = high[..., None]**powers - low[..., None]**powers
+        anchor = np.sum(spans * integrals[:, None, :], axis=-1)
+        tested = np.sum(spans * integrals[None, :, :], axis=-1)
+        differences = (tested - anchor) / (high - low)
+    differences[~(high > low)] = np.nan
+    return differences
+
+
+# Returns the Bjøntegaard-delta rate (in %) and quality matrices of the
+# formats for a metric, from their averages
+def get_bd_matrices(data, formats, column):
+    log_rates = [np.log10(data[format]["avg_bpp"].values) for format in formats]
+    qualities = [data[format][column].values for format in formats]
+    bd_rate = (10**get_average_differences(list(zip(qualities, log_rates))) -
+               1) * 100
+    bd_quality = get_average_differences(list(zip(log_rates, qualities)))
+    return (bd_rate, bd_quality)
+
+
+# Writes a table as CSV, and as Markdown with 2 decimals
+def write_table(table, results_file):
+    table.to_csv(results_file + ".csv", index=False)
+    file = open(results_file + ".md", "w")
+    markdown_writer = pytablewriter.MarkdownTableWriter()
+    markdown_writer.from_dataframe(table.round(2))
+    markdown_writer.stream = six.StringIO()
+    markdown_writer.write_table()
+    file.write(markdown_writer.stream.getvalue())
+    file.close()
+    print("BD results successfully saved to {}.csv and {}.md.".format(
+        results_file, results_file))
+
+
+def generate_bd_tables(path, requested_formats):
+    subset_name = os.path.basename(path)
+
+    # Only the averages of rd_average.py, whose resolution is a height or
+    # 'any', and not the tables of rd_plot.py like the crf_conversion ones
+    prefix = subset_name + "." + requested_formats[0] + "."
+    resolution_list = []
+    for f in glob.glob(path + "/" + prefix + "*.lossy.out"):
+        resolution = os.path.basename(f)[len(prefix):-len(".lossy.out")]
+        if resolution.isdigit() or resolution == "any":
+            resolution_list.append(resolution)
+
+    for resolution in resolution_list:
+        data = {}
+        for format in requested_formats:
+            file = get_average_file(path, format, resolution)
+            if os.path.isfile(file):
+                data[format] = pd.read_csv(file, sep=":")
+        formats = [format for format in requested_formats if format in data]
+
+        bd_rate_table = []
+        bd_quality_table = []
+        for (metric, column) in metrics:
+            (bd_rate, bd_quality) = get_bd_matrices(data, formats, column)
+            for table, matrix in ((bd_rate_table, bd_rate),
+                                  (bd_quality_table, bd_quality)):
+                table.append(
+                    pd.DataFrame(matrix, columns=formats).assign(
+                        metric=metric, anchor=formats))
+
+        for name, table in (("bd_rate", bd_rate_table),
+                            ("bd_quality", bd_quality_table)):
+            table = pd.concat(table, ignore_index=True)
+            write_table(table[["metric", "anchor"] + formats],
+                        path + "/" + subset_name + "." + name + "." +
+                        str(resolution))
+
+
+def main(argv):
+    if sys.version_info[0] < 3 and sys.version_info[1] < 5:
+        raise Exception("Python 3.5 or a more recent version is required.")
+
+    if len(argv) < 2 or len(argv) > 3:
+        print(
+            "rd_bdrate.py: Calculate the Bjøntegaard-delta rate and quality of every pair of formats"
+        )
+        print(
+            "Arg 1: Path to a subset with results generated by rd_average.py")
+        print("       For ex: rd_bdrate.py \"results/subset1\"")
+        print("Arg 2: Comma-separated list of formats to compare, all of them by default.")
+        print(
+            "       For ex: rd_bdrate.py \"results/subset1\" \"av1,vp9,x264,x265\""
+        )
+        return
+
+    results_folder = os.path.normpath(argv[1])
+
+    if (not os.path.isdir(results_folder)
+            or not glob.glob(results_folder + "/*.any.lossy.out")):
+        print(
+            "Could not find all results file. Please make sure the path provided is correct."
+        )
+        return
+
+    available_formats = []
+    for f in glob.glob(results_folder + "/*.any.lossy.out"):
+        available_formats.append(os.path.basename(f).split(".")[1])
+
+    try:
+        requested_formats = [format.strip() for format in argv[2].split(",")]
+    except IndexError:
+        requested_formats = sorted(available_formats)
+
+    for format in requested_formats:
+        if format not in available_formats:
+            print("The format {} is not in the list of available formats {}".
+                  format(format, available_formats))
+            return
+
+    generate_bd_tables(results_folder, requested_formats)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
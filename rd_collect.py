@@ -40,13 +40,30 @@ import re
 import shlex
 import string
 import json
-from multiprocessing import Pool
-from timeit import Timer
+import getopt
+import functools
+import hashlib
+import itertools
+import job_queue
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import Pool, Value
 import numpy as np
+import metrics
+import results_store
+import source_cache
+import staging
+import streaming
+import tracing
+import y4m
 
 # Paths to various programs and config files used by the tests #
 # Conversion
 convert = "ffmpeg"
+convert_args = "-pix_fmt yuv420p10le -strict -1"
 
 # Tests
 rgbssim = "dump_ssim"
@@ -58,8 +75,54 @@ vmaf = "vmafossexec yuv420p10le"
 # Path to tmp dir to be used by the tests
 tmpdir = "/tmp/"
 
+# Path to the cache of prepared sources, and its size budget in bytes
+cachedir = tmpdir + "rd_cache/"
+cache_budget = 100 * 1024 * 1024 * 1024
+
+# Tiers of the staging area of the decoded videos, fastest first, and their
+# size budgets in bytes (see staging.py). The jobs wait for room in one of
+# them before encoding.
+staging_tiers = [("/dev/shm/rd_staging/", 4 * 1024 * 1024 * 1024),
+                 (tmpdir + "rd_staging/", 64 * 1024 * 1024 * 1024)]
+
+# Streaming mode: the decoded videos are piped to the metric tools instead of
+# being staged. The tools listed in seeking_tools need to seek in their input,
+# and still get a regular file.
+stream = False
+seeking_tools = []
+
+# Number of times the encoder and the decoder are run to time them. The
+# results then hold the median of the runs, and the spread of their wall
+# times.
+repeat = 1
+
+# Metrics computed in-process by the metrics module instead of the external
+# tools, among "y_ssim" and "msssim"
+native_metrics = []
+
+# Number of scales of the native metrics, which the clips must be large
+# enough for
+native_scales = {'y_ssim': 1, 'msssim': len(metrics.msssim_weights)}
+
+# Keep the per-frame scores of every metric (see results_store.py)
+capture_frames = False
+
+# Trace file of the stages of the run (see tracing.py), None to disable
+trace_file = None
+
+# Encode every point again, even when its bitstream is in the encode cache
+reencode = False
+
 #############################################################################
 
+# Number of free CPU slots, shared between the scheduler and its workers
+cpu_slots = None
+
+# Seconds after which a job claimed by a worker that stopped refreshing it is
+# given to another worker, and seconds between two scans of the queue
+lease = 600
+poll_interval = 1
+
 
 def split(cmd):
     lex = shlex.shlex(cmd)
@@ -80,11 +143,86 @@ def run_silent(cmd):
     return rv
 
 
-def wrapper(func, *args, **kwargs):
-    def wrapped():
-        return func(*args, **kwargs)
+# Runs cmd like run_silent, and returns its wall time, its user and system
+# CPU times, and its peak resident set size in KiB.
+def run_timed(cmd):
+    start = time.perf_counter()
+    proc = subprocess.Popen(split(cmd))
+    (pid, status, rusage) = os.wait4(proc.pid, 0)
+    wall_time = time.perf_counter() - start
+    if os.WIFEXITED(status):
+        proc.returncode = os.WEXITSTATUS(status)
+    else:
+        proc.returncode = -os.WTERMSIG(status)
+    if proc.returncode != 0:
+        sys.stderr.write("Failure from subprocess:\n")
+        sys.stderr.write("\t" + cmd + "\n")
+        sys.stderr.write("Aborting!\n")
+        sys.exit(proc.returncode)
+    return (wall_time, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss)
+
 
-    return wrapped
+# Runs the passes of a stage once, and returns their summed times and their
+# peak resident set size. The span of each pass is tagged with the size of
+# the input of the stage.
+def time_commands(cmds, stage, input_size=None):
+    sample = (0, 0, 0, 0)
+    for i, cmd in enumerate(cmds):
+        if len(cmds) > 1:
+            name = "%s pass %d" % (stage, i + 1)
+        else:
+            name = stage
+        with tracing.span(name, bytes=input_size):
+            (wall_time, user_time, sys_time, maxrss) = run_timed(cmd)
+        sample = (sample[0] + wall_time, sample[1] + user_time,
+                  sample[2] + sys_time, max(sample[3], maxrss))
+    return sample
+
+
+def summarize_timings(samples):
+    wall_times = [sample[0] for sample in samples]
+    return {
+        'time': float(np.median(wall_times)),
+        'user_time': float(np.median([sample[1] for sample in samples])),
+        'sys_time': float(np.median([sample[2] for sample in samples])),
+        'maxrss': max(sample[3] for sample in samples),
+        'time_spread': max(wall_times) - min(wall_times)
+    }
+
+
+def init_worker(slots, settings):
+    global cpu_slots
+    cpu_slots = slots
+    globals().update(settings)
+    if trace_file is not None:
+        tracing.enable(trace_file)
+
+
+# Takes up to count free CPU slots without waiting, and returns how many
+# were actually taken.
+def borrow_slots(count):
+    if cpu_slots is None or count <= 0:
+        return 0
+    with cpu_slots.get_lock():
+        count = min(count, cpu_slots.value)
+        cpu_slots.value -= count
+    return count
+
+
+# Takes exactly count free CPU slots, or none of them.
+def take_slots(count):
+    with cpu_slots.get_lock():
+        if cpu_slots.value < count:
+            return False
+        cpu_slots.value -= count
+    return True
+
+
+def release_slots(count):
+    if cpu_slots is None or count <= 0:
+        return
+    with cpu_slots.get_lock():
+        cpu_slots.value += count
 
 
 def create_dir(path):
@@ -96,63 +234,191 @@ def create_dir(path):
                 raise
 
 
-def path_for_file_in_tmp(path):
-    return tmpdir + str(os.getpid()) + os.path.basename(path)
-
-
-def get_video_width(path):
-    cmd = "ffprobe -v error -show_entries stream=width -of default=noprint_wrappers=1 %s" % (path)
-    proc = subprocess.Popen(
-        split(cmd),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        encoding="utf-8")
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        sys.stderr.write("Failed process: ffprobe\n")
-        sys.exit(proc.returncode)
-    lines = out.split(os.linesep)
-    width = float(re.search('(?<=width=)\d+\.?\d*', lines[-2]).group(0))
-    return int(width)
-
-
-def get_video_height(path):
-    cmd = "ffprobe -v error -show_entries stream=height -of default=noprint_wrappers=1 %s" % (path)
-    proc = subprocess.Popen(
-        split(cmd),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        encoding="utf-8")
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        sys.stderr.write("Failed process: ffprobe\n")
-        sys.exit(proc.returncode)
-    lines = out.split(os.linesep)
-    height = float(re.search('(?<=height=)\d+\.?\d*', lines[-2]).group(0))
-    return int(height)
-
-
-def get_video_frames(path):
-    cmd = "ffprobe -v error -count_frames -select_streams v:0 -show_entries stream=nb_read_frames -of default=noprint_wrappers=1 %s" % (path)
-    proc = subprocess.Popen(
-        split(cmd),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        encoding="utf-8")
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        sys.stderr.write("Failed process: ffprobe\n")
-        sys.exit(proc.returncode)
-    lines = out.split(os.linesep)
-    frames = float(re.search('(?<=nb_read_frames=)\d+\.?\d*', lines[-2]).group(0))
-    return int(frames)
-
-
 def convert_video(inn, out):
-    cmd = "%s -y -i %s -pix_fmt yuv420p10le -strict -1 %s" % (convert, inn, out)
-    run_silent(cmd)
+    cmd = "%s -y -i %s %s %s" % (convert, inn, convert_args, out)
+    with tracing.span("convert") as span:
+        run_silent(cmd)
+        span['bytes'] = os.path.getsize(out)
 
 
+# Converts a Y4M video to the raw YUV read by VMAF. The frames of a 10 bits
+# 4:2:0 video are already in the right format, and are only copied past
+# their FRAME lines, without ffmpeg decoding and encoding them again.
+def y4m_to_yuv(inn, out):
+    try:
+        header = y4m.probe(inn)
+    except ValueError:
+        header = None
+    if (header is None or header['chroma'] != "420"
+            or header['bit_depth'] != 10):
+        convert_video(inn, out)
+        return
+    with tracing.span("y4m to yuv") as span:
+        y4m.to_raw(inn, out, header)
+        span['bytes'] = os.path.getsize(out)
+
+
+# Returns the indexes of the frames of a video of the given number of frames
+# kept by a preview, all of them if preview is None. A preview is either
+# "every:N", every Nth frame, or "windows:count:length", count windows of
+# length consecutive frames evenly spread over the video.
+def get_preview_frames(preview, frames):
+    if preview is None:
+        return list(range(frames))
+    values = preview.split(":")
+    if values[0] == "every" and len(values) == 2 and int(values[1]) >= 1:
+        return list(range(0, frames, int(values[1])))
+    if (values[0] == "windows" and len(values) == 3 and int(values[1]) >= 1
+            and int(values[2]) >= 1):
+        length = min(int(values[2]), frames)
+        starts = np.linspace(0, frames - length, int(values[1]))
+        return sorted(
+            set(i for start in np.round(starts).astype(int)
+                for i in range(start, start + length)))
+    raise ValueError("Invalid preview: " + preview)
+
+
+# Writes the frames of a Y4M video kept by a preview to every output, a list
+# of (path, raw) tuples, in a single pass
+def extract_preview(preview, source, outputs):
+    header = y4m.probe(source)
+    y4m.extract_frames(source, get_preview_frames(preview, header['frames']),
+                       outputs, header)
+
+
+# Yields the 10 bits Y4M and raw YUV versions of a source, converted once
+# and then shared by every quality step and format through the cache. With a
+# preview, the 10 bits Y4M is followed by the Y4M and raw YUV versions of
+# the frames it keeps, which replace the full ones as references.
+@contextmanager
+def prepared_source(origy4m, preview=None):
+    params = [convert, convert_args]
+    with source_cache.prepared(
+            cachedir, cache_budget, origy4m, ".10bits.y4m", params,
+            lambda path: convert_video(origy4m, path)) as origy4m_10bits:
+        if preview is None:
+            with source_cache.prepared(
+                    cachedir, cache_budget, origy4m, ".yuv", params,
+                    lambda path: y4m_to_yuv(origy4m_10bits,
+                                            path)) as origyuv:
+                yield (origy4m_10bits, origy4m_10bits, origyuv)
+            return
+
+        params = params + ["preview", preview]
+        with source_cache.prepared(
+                cachedir, cache_budget, origy4m, ".preview.10bits.y4m",
+                params, lambda path: extract_preview(
+                    preview, origy4m_10bits,
+                    [(path, False)])) as preview_y4m:
+            with source_cache.prepared(
+                    cachedir, cache_budget, origy4m, ".preview.yuv", params,
+                    lambda path: extract_preview(
+                        None, preview_y4m, [(path, True)])) as preview_yuv:
+                yield (origy4m_10bits, preview_y4m, preview_yuv)
+
+
+# Returns the SHA-256 of the content of a source, kept in the cache of
+# prepared sources so that it is only computed once per clip
+def get_source_hash(origy4m):
+    def build(path):
+        digest = hashlib.sha256()
+        with open(origy4m, "rb") as source:
+            for chunk in iter(lambda: source.read(1 << 20), b""):
+                digest.update(chunk)
+        with open(path, "w") as f:
+            f.write(digest.hexdigest())
+
+    with tracing.span("source hash", bytes=os.path.getsize(origy4m)):
+        with source_cache.prepared(cachedir, cache_budget, origy4m, ".sha256",
+                                   ["sha256"], build) as hash_file:
+            with open(hash_file) as f:
+                return f.read()
+
+
+# Encode cache: the bitstream of a point is kept in <FORMAT>_out/ with a
+# sidecar, <bitstream>.json, recording the key it was encoded for and its
+# encode timing. The key is the hash of the content of the source, of the
+# conversion to 10 bits, of the expanded encoder commands and of the quality,
+# the path of the prepared source being left out of the commands as it
+# depends on the cache. A point whose key and bitstream size match its
+# sidecar is not encoded again, and gets the timing of the sidecar.
+def get_encode_key(origy4m, origy4m_10bits, cmds, quality):
+    description = json.dumps([
+        get_source_hash(origy4m), [convert, convert_args],
+        [cmd.replace(origy4m_10bits, "$origy4m_10bits") for cmd in cmds],
+        quality_key(quality)
+    ])
+    return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+
+def read_encode_cache(target, key):
+    try:
+        with open(target + ".json") as f:
+            entry = json.load(f)
+        if entry['key'] == key and entry['size'] == os.path.getsize(target):
+            return entry['encode_timing']
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def write_encode_cache(target, key, encode_timing):
+    entry = {
+        'key': key,
+        'size': os.path.getsize(target),
+        'encode_timing': encode_timing
+    }
+    tmp_file = target + ".json." + job_queue.get_worker_id() + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(entry, f)
+    os.replace(tmp_file, target + ".json")
+
+
+# Returns the path an attempt at a point encodes to, before it is renamed to
+# target. A job requeued after missing its lease may be run by a second
+# worker while the first one is still running it: each encodes to its own
+# path, keeping the extension of target for the encoders that depend on it.
+def get_attempt_path(target):
+    (base, extension) = os.path.splitext(target)
+    return base + "." + job_queue.get_worker_id() + ".tmp" + extension
+
+
+# Moves the bitstream of an attempt to target, and records its sidecar
+def publish_encode(attempt, target, key, encode_timing):
+    os.replace(attempt, target)
+    for path in glob.glob(glob.escape(attempt) + ".*"):
+        # Files written next to the bitstream, like first pass statistics
+        os.remove(path)
+    write_encode_cache(target, key, encode_timing)
+
+
+# Returns the per-frame scores printed by the dump_* tools, one
+# "<frame>: <score>" line per frame
+def parse_frame_scores(lines):
+    scores = []
+    for line in lines:
+        match = re.match(r'\s*\d+:\s+(\S+)', line)
+        if match:
+            scores.append(float(match.group(1)))
+    return np.array(scores)
+
+
+# Runs a score function in a span, tagged with the size of the decoded video
+# when it is a regular file
+def traced_metric(func):
+    @functools.wraps(func)
+    def wrapper(*args):
+        with tracing.span(func.__name__) as span:
+            if tracing.is_enabled() and os.path.isfile(args[-1]):
+                span['bytes'] = os.path.getsize(args[-1])
+            return func(*args)
+
+    return wrapper
+
+
+# The score functions return the score of the whole video, and its per-frame
+# scores (None if not captured)
+@traced_metric
 def score_y_ssim(y4m1, y4m2):
     cmd = "%s %s %s" % (yssim, y4m1, y4m2)
     proc = subprocess.Popen(
@@ -166,9 +432,10 @@ def score_y_ssim(y4m1, y4m2):
         sys.exit(proc.returncode)
     lines = out.split(os.linesep)
     qscore = float(re.search('(?<=Total: )\d+\.?\d*', lines[-2]).group(0))
-    return qscore
+    return (qscore, parse_frame_scores(lines))
 
 
+@traced_metric
 def score_psnrhvsm(y4m1, y4m2):
     cmd = "%s %s %s" % (psnrhvsm, y4m1, y4m2)
     proc = subprocess.Popen(
@@ -182,9 +449,10 @@ def score_psnrhvsm(y4m1, y4m2):
         sys.exit(proc.returncode)
     lines = out.split(os.linesep)
     qscore = float(re.search('(?<=Total: )\d+\.?\d*', lines[-2]).group(0))
-    return qscore
+    return (qscore, parse_frame_scores(lines))
 
 
+@traced_metric
 def score_rgb_ssim(y4m1, y4m2):
     cmd = "%s %s %s" % (rgbssim, y4m1, y4m2)
     proc = subprocess.Popen(
@@ -198,9 +466,10 @@ def score_rgb_ssim(y4m1, y4m2):
         sys.exit(proc.returncode)
     lines = out.split(os.linesep)
     qscore = float(re.search('(?<=Total: )\d+\.?\d*', lines[-2]).group(0))
-    return qscore
+    return (qscore, parse_frame_scores(lines))
 
 
+@traced_metric
 def score_msssim(y4m1, y4m2):
     cmd = "%s %s %s" % (msssim, y4m1, y4m2)
     proc = subprocess.Popen(
@@ -214,12 +483,16 @@ def score_msssim(y4m1, y4m2):
         sys.exit(proc.returncode)
     lines = out.split(os.linesep)
     qscore = float(re.search('(?<=Total: )\d+\.?\d*', lines[-2]).group(0))
-    return qscore
+    return (qscore, parse_frame_scores(lines))
 
 
+@traced_metric
 def score_vmaf(width, height, yuv1, yuv2):
     cmd = "%s %s %s %s %s %s" % (vmaf, width, height, yuv1, yuv2,
                                  "vmaf_v0.6.1.pkl")
+    log = yuv2 + ".vmaf.json"
+    if capture_frames:
+        cmd += " --log %s --log-fmt json" % log
     proc = subprocess.Popen(
         split(cmd),
         stdout=subprocess.PIPE,
@@ -232,81 +505,306 @@ def score_vmaf(width, height, yuv1, yuv2):
     lines = out.split(os.linesep)
     qscore = float(
         re.search('(?<=VMAF score = )\d+\.?\d*', lines[-2]).group(0))
-    return qscore
+    if not capture_frames:
+        return (qscore, None)
+    with open(log) as f:
+        frames = json.load(f)['frames']
+    os.remove(log)
+    return (qscore, np.array([frame['metrics']['vmaf'] for frame in frames]))
+
+
+# Yields the SSIM statistics of the 10 bits reference, computed once per clip
+# and kept in the cache of prepared sources. They are shared by Y-SSIM and
+# MS-SSIM when both are native.
+@contextmanager
+def reference_stats(origy4m, preview, origy4m_10bits):
+    scales = native_scales['msssim' if 'msssim' in native_metrics else 'y_ssim']
+    params = [
+        convert, convert_args, "ssim", scales, metrics.window_size,
+        metrics.window_sigma
+    ]
+    if preview is not None:
+        params += ["preview", preview]
+    with source_cache.prepared(
+            cachedir, cache_budget, origy4m, ".ssim%d.npy" % scales,
+            params, lambda path: metrics.write_reference_stats(
+                origy4m_10bits, scales, path)) as path:
+        yield metrics.read_reference_stats(origy4m_10bits, scales, path)
+
+
+@traced_metric
+def score_native_y_ssim(origy4m, preview, y4m1, y4m2):
+    with reference_stats(origy4m, preview, y4m1) as stats:
+        frames = metrics.y_ssim_frames(y4m1, y4m2, stats[:1])
+    return (metrics.to_db(np.mean(frames)), metrics.frames_to_db(frames))
+
+
+@traced_metric
+def score_native_msssim(origy4m, preview, y4m1, y4m2):
+    with reference_stats(origy4m, preview, y4m1) as stats:
+        frames = metrics.msssim_frames(y4m1, y4m2, stats)
+    return (metrics.to_db(np.mean(frames)), metrics.frames_to_db(frames))
+
+
+# Runs the given (function, args) metrics concurrently, using the CPU slots
+# of the job plus any slot left free by the other jobs, and returns their
+# scores in order. With all_at_once, every metric is started right away even
+# if there are not enough free slots.
+def run_metrics(scorers, threads, all_at_once=False):
+    borrowed = borrow_slots(len(scorers) - threads)
+    if all_at_once:
+        max_workers = len(scorers)
+    else:
+        max_workers = min(len(scorers), threads + borrowed)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(func, *args) for (func, args) in scorers]
+            return [future.result() for future in futures]
+    finally:
+        release_slots(borrowed)
 
 
-# Returns tuple containing:
-#   (target_file_size, encode_time, decode_time, yssim_score, rgbssim_score,
-#   psnrhvsm_score, msssim_score)
-def get_lossy_results(subset_name, origy4m, width, height, format,
-                      format_recipe, quality):
-    origy4m_10bits = path_for_file_in_tmp(origy4m) + ".10bits.y4m"
-    convert_video(origy4m, origy4m_10bits)
-    origyuv = path_for_file_in_tmp(origy4m) + ".yuv"
-    convert_video(origy4m_10bits, origyuv)
+def consume(func, args, ready, abandoned):
+    try:
+        if ready is not None:
+            ready.wait()
+        return func(*args)
+    finally:
+        abandoned.set()
+
+
+# Runs the decoder with its output piped to every metric, and returns the
+# scores. All the metrics have to run at once since they read the decoded
+# video at the same pace.
+def stream_decoded(cmd, target_dec, scorers, threads, input_size):
+    tee_done = threading.Event()
+    outputs = []
+    consumers = []
+    for i, (func, tool, args, kind) in enumerate(scorers):
+        path = target_dec + "." + str(i) + "." + kind
+        abandoned = threading.Event()
+        # The native metrics map their input, which has to be a regular file
+        if tool is None or tool in seeking_tools:
+            ready = tee_done
+        else:
+            streaming.make_fifo(path)
+            ready = None
+        outputs.append((path, kind == "yuv", abandoned))
+        consumers.append((consume, (func, args + (path, ), ready, abandoned)))
+
+    def run_tee():
+        try:
+            streaming.tee(target_dec, outputs)
+        finally:
+            tee_done.set()
 
+    streaming.make_fifo(target_dec)
+    try:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            teed = executor.submit(run_tee)
+            scores = executor.submit(run_metrics, consumers, threads, True)
+            try:
+                time_commands([cmd], "streamed decode", input_size)
+            finally:
+                streaming.release_reader(target_dec)
+            teed.result()
+            return scores.result()
+    finally:
+        for path in [target_dec] + [output[0] for output in outputs]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# Times a run of the decoder with its output piped to a reader that throws it
+# away, so that the decoder neither waits for the metrics nor stages the
+# decoded video
+def time_drained_decode(cmd, drain_path, input_size):
+    streaming.make_fifo(drain_path)
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            drained = executor.submit(streaming.drain, drain_path)
+            try:
+                sample = time_commands([cmd], "decode", input_size)
+            finally:
+                # The reader may not be waiting yet if the decoder failed
+                # before opening the fifo
+                while not drained.done():
+                    streaming.release_reader(drain_path)
+                    time.sleep(0.01)
+            drained.result()
+            return sample
+    finally:
+        os.remove(drain_path)
+
+
+# Returns the metrics of a point as (function, tool, reference arguments,
+# decoded input) tuples, the native metrics having no tool
+def get_scorers(origy4m, reference_y4m, reference_yuv, width, height,
+                preview=None):
+    scorers = [(score_y_ssim, yssim, (reference_y4m, ), "y4m"),
+               (score_rgb_ssim, rgbssim, (reference_y4m, ), "y4m"),
+               (score_psnrhvsm, psnrhvsm, (reference_y4m, ), "y4m"),
+               (score_msssim, msssim, (reference_y4m, ), "y4m"),
+               (score_vmaf, vmaf, (width, height, reference_yuv), "yuv")]
+    if 'y_ssim' in native_metrics:
+        scorers[0] = (score_native_y_ssim, None,
+                      (origy4m, preview, reference_y4m), "y4m")
+    if 'msssim' in native_metrics:
+        scorers[3] = (score_native_msssim, None,
+                      (origy4m, preview, reference_y4m), "y4m")
+    return scorers
+
+
+# Size in bytes of the files staged by a point: the decoded video, and its
+# conversions to Y4M and raw YUV when the decoder outputs neither. A streamed
+# video only takes room for the metrics that need a regular file, and a
+# preview for the frames it keeps.
+def get_staging_size(clip, format_recipe, scorers):
+    # The decoded videos are 10 bits 4:2:0, like the prepared sources
+    frame_size = y4m.frame_size({
+        'width': clip['width'],
+        'height': clip['height'],
+        'chroma': "420",
+        'bit_depth': 10
+    }) + len(y4m.frame_signature) + 1
+    decode_extension = format_recipe['decode_extension']
+    preview = clip.get('preview')
+    if preview is not None:
+        # The decoded video and its Y4M version, then the Y4M and raw YUV
+        # versions of the frames kept
+        frames = (1 + (decode_extension != 'y4m')) * clip['frames'] + \
+            2 * len(get_preview_frames(preview, clip['frames']))
+    elif stream and decode_extension == 'y4m':
+        frames = clip['frames'] * len([
+            tool for (func, tool, args, kind) in scorers
+            if tool is None or tool in seeking_tools
+        ])
+    elif decode_extension in ('y4m', 'yuv'):
+        frames = 2 * clip['frames']
+    else:
+        frames = 3 * clip['frames']
+    # Plus some room for the headers and the logs of the tools
+    return frames * frame_size + 1024 * 1024
+
+
+# Returns tuple containing:
+#   (target_file_size, encode_timing, decode_timing, yssim_score,
+#   rgbssim_score, msssim_score, psnrhvsm_score, vmaf_score)
+# where the timings are dicts returned by summarize_timings(). The decoded
+# videos are written to staging_dir. With a preview, the metrics only get the
+# frames it keeps.
+def get_lossy_results(subset_name, origy4m, origy4m_10bits, origyuv, width,
+                      height, format, format_recipe, quality, threads, scorers,
+                      staging_dir, preview=None):
     target = format.upper() + "_out/" + subset_name + "/" + os.path.splitext(
         os.path.basename(origy4m))[0] + "/" + os.path.splitext(
             os.path.basename(origy4m))[0] + "-q" + str(quality)
     create_dir(target)
-    target_dec = path_for_file_in_tmp(target)
+    target_dec = os.path.join(staging_dir, os.path.basename(target))
 
     target += "." + format_recipe['encode_extension']
-    cmd = string.Template(format_recipe['encode_cmd']).substitute(locals())
-    wrapped = wrapper(run_silent, cmd)
-    encode_time = Timer(wrapped).timeit(1)
+    final_target = target
+    templates = [format_recipe['encode_cmd']]
     if 'second_pass' in format_recipe:
-        cmd = string.Template(format_recipe['second_pass']).substitute(locals())
-        wrapped = wrapper(run_silent, cmd)
-        encode_time = encode_time + Timer(wrapped).timeit(1)
+        templates.append(format_recipe['second_pass'])
+    variables = locals()
+    cmds = [string.Template(cmd).substitute(variables) for cmd in templates]
+    key = get_encode_key(origy4m, origy4m_10bits, cmds, quality)
+    encode_timing = None
+    if not reencode:
+        encode_timing = read_encode_cache(target, key)
+    if encode_timing is None:
+        # The point is encoded, decoded and measured from the bitstream of
+        # this attempt, which replaces target once its results are known
+        target = get_attempt_path(final_target)
+        cmds = [
+            string.Template(cmd).substitute(variables, target=target)
+            for cmd in templates
+        ]
+        input_size = os.path.getsize(origy4m_10bits)
+        encode_timing = summarize_timings(
+            [time_commands(cmds, "encode", input_size) for i in range(repeat)])
 
     target_dec += "." + format_recipe['decode_extension']
     cmd = string.Template(format_recipe['decode_cmd']).substitute(locals())
-    wrapped = wrapper(run_silent, cmd)
-    decode_time = Timer(wrapped).timeit(1)
-
-    if format_recipe['decode_extension'] == 'y4m':
-        target_y4m = target_dec
+    input_size = os.path.getsize(target)
+    if (stream and preview is None
+            and format_recipe['decode_extension'] == 'y4m'):
+        # The streamed decode runs at the pace of the slowest metric, so the
+        # decoder is timed on its own, its output being drained
+        drain_path = target_dec + ".drain." + format_recipe['decode_extension']
+        drain_cmd = string.Template(format_recipe['decode_cmd']).substitute(
+            dict(locals(), target_dec=drain_path))
+        decode_timing = summarize_timings(
+            [time_drained_decode(drain_cmd, drain_path, input_size)
+             for i in range(repeat)])
+        scores = stream_decoded(cmd, target_dec, scorers, threads, input_size)
+        target_y4m = target_yuv = target_dec
     else:
-        target_y4m = path_for_file_in_tmp(target_dec) + ".y4m"
-        convert_video(target_dec, target_y4m)
+        decode_timing = summarize_timings(
+            [time_commands([cmd], "decode", input_size)
+             for i in range(repeat)])
 
-    if format_recipe['decode_extension'] == 'yuv':
-        target_yuv = target_dec
-    else:
-        target_yuv = path_for_file_in_tmp(target_dec) + ".yuv"
-        convert_video(target_dec, target_yuv)
+        if format_recipe['decode_extension'] == 'y4m':
+            target_y4m = target_dec
+        else:
+            target_y4m = target_dec + ".y4m"
+            convert_video(target_dec, target_y4m)
+
+        if preview is not None:
+            # The frames kept, in Y4M and raw YUV, extracted in a single pass
+            decoded_y4m = target_y4m
+            target_y4m = target_dec + ".preview.y4m"
+            target_yuv = target_dec + ".preview.yuv"
+            with tracing.span("preview"):
+                extract_preview(preview, decoded_y4m,
+                                [(target_y4m, False), (target_yuv, True)])
+        elif format_recipe['decode_extension'] == 'yuv':
+            target_yuv = target_dec
+        else:
+            target_yuv = target_dec + ".yuv"
+            y4m_to_yuv(target_y4m, target_yuv)
 
-    yssim_score = score_y_ssim(origy4m_10bits, target_y4m)
-    rgb_ssim_score = score_rgb_ssim(origy4m_10bits, target_y4m)
-    psnrhvsm_score = score_psnrhvsm(origy4m_10bits, target_y4m)
-    msssim_score = score_msssim(origy4m_10bits, target_y4m)
-    vmaf_score = score_vmaf(width, height, origyuv, target_yuv)
+        decoded = {"y4m": target_y4m, "yuv": target_yuv}
+        scores = run_metrics([(func, args + (decoded[kind], ))
+                              for (func, tool, args, kind) in scorers],
+                             threads)
 
-    target_file_size = os.path.getsize(target)
+    (yssim_score, rgb_ssim_score, psnrhvsm_score,
+     msssim_score, vmaf_score) = [score for (score, frames) in scores]
+    # The per-frame scores of a preview would take the place of the full ones
+    if capture_frames and preview is None:
+        save_frame_scores(subset_name, format, origy4m, quality, scores)
 
-    try:
-        os.remove(origy4m_10bits)
-        os.remove(origyuv)
-        os.remove(target_dec)
-        os.remove(target_yuv)
-        os.remove(target_y4m)
-    except FileNotFoundError:
-        pass
+    target_file_size = os.path.getsize(target)
+    if target != final_target:
+        publish_encode(target, final_target, key, encode_timing)
 
-    return (target_file_size, encode_time, decode_time, yssim_score,
+    return (target_file_size, encode_timing, decode_timing, yssim_score,
             rgb_ssim_score, msssim_score, psnrhvsm_score, vmaf_score)
 
 
-def process_image(args):
-    [format, format_recipe, subset_name, origy4m] = args
-
-    result_file = "results/" + subset_name + "/" + format + "/lossy/" + \
-        os.path.splitext(os.path.basename(origy4m))[0] + "." + format + ".out"
-    if os.path.isfile(result_file) and not os.stat(result_file).st_size < 182:
-        return
-
-
+# Saves the per-frame scores of a point, in the order of frame_metrics. The
+# frames missing from the output of a tool are NaN.
+def save_frame_scores(subset_name, format, origy4m, quality, scores):
+    (yssim, rgb_ssim, psnrhvsm, msssim, vmaf) = [
+        frames for (score, frames) in scores
+    ]
+    rows = [yssim, rgb_ssim, msssim, psnrhvsm, vmaf]
+    length = max(len(frames) for frames in rows if frames is not None)
+    array = np.full((len(rows), length), np.nan, dtype=np.float32)
+    for i, frames in enumerate(rows):
+        if frames is not None:
+            array[i, :len(frames)] = frames
+    results_store.write_frames(
+        results_store.get_frames_file(
+            "results/" + subset_name, format,
+            os.path.splitext(os.path.basename(origy4m))[0], quality), array)
+
+
+def get_quality_list(format_recipe):
     try:
         isfloat = isinstance(format_recipe['quality_start'], float) or isinstance(format_recipe['quality_end'], float) or isinstance(format_recipe['quality_step'], float)
         
@@ -320,55 +818,693 @@ def process_image(args):
             step = int(format_recipe['quality_step'])
     except ValueError:
         print('There was an error parsing the format recipe.')
-        return
+        return None
 
     if (not 'encode_extension' in format_recipe
             or not 'decode_extension' in format_recipe
             or not 'encode_cmd' in format_recipe
             or not 'decode_cmd' in format_recipe):
         print('There was an error parsing the format recipe.')
-        return
+        return None
 
-    orig_file_size = os.path.getsize(origy4m)
-    width = get_video_width(origy4m)
-    height = get_video_height(origy4m)
-    frames = get_video_frames(origy4m)
-    pixels = width * height * frames
-
-    # Lossy
-    path = "results/" + subset_name + "/" + format + "/lossy/" + os.path.splitext(
-        os.path.basename(origy4m))[0] + "." + format + ".out"
-    create_dir(path)
-    file = open(path, "w")
-
-    file.write(
-        "file_name:quality:orig_file_size:compressed_file_size:height:frames:pixels:bpp:compression_ratio:encode_time:encode_fpm:decode_time:decode_fpm:y_ssim_score:rgb_ssim_score:msssim_score:psnrhvsm_score:vmaf_score\n"
-    )
     if isfloat:
-        quality_list = list(np.arange(start, end, step))
+        return list(np.arange(start, end, step))
     else:
-        quality_list = list(range(start, end, step))
-
-    i = 0
-    while i < len(quality_list):
-        quality = quality_list[i]
-        print("Processing video {}, quality {}".format(
-            os.path.basename(origy4m), quality))
-        results = get_lossy_results(subset_name, origy4m, width, height,
-                                    format, format_recipe, quality)
-        bpp = results[0] * 8 / pixels
-        compression_ratio = orig_file_size / results[0]
-        encode_fpm = frames / results[1] * 60
-        decode_fpm = frames / results[2] * 60
-        file.write("%s:%f:%d:%d:%d:%d:%d:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f\n" %
-                   (os.path.splitext(os.path.basename(origy4m))[0], quality,
-                    orig_file_size, results[0], height, frames, pixels, bpp, 
-                    compression_ratio, results[1], encode_fpm, results[2], 
-                    decode_fpm, results[3], results[4], results[5], 
-                    results[6], results[7]))
-        i += 1
+        return list(range(start, end, step))
+
+
+# Number of CPU slots taken by a job of the given recipe. A value of 0 means
+# that the encoder uses every core it can find.
+def get_job_threads(format_recipe, cpu_budget):
+    threads = int(format_recipe.get('threads', 1))
+    if threads <= 0 or threads > cpu_budget:
+        return cpu_budget
+    return threads
 
+
+# The results of the previews are kept apart from the full ones, in
+# results/<subset>/<format>/preview/, which rd_average.py does not read
+def get_result_file(subset_name, format, origy4m, preview=None):
+    if preview is None:
+        kind = "lossy"
+    else:
+        kind = "preview"
+    return "results/" + subset_name + "/" + format + "/" + kind + "/" + \
+        os.path.splitext(os.path.basename(origy4m))[0] + "." + format + ".out"
+
+
+def probe_image(origy4m):
+    orig_file_size = os.path.getsize(origy4m)
+    try:
+        with tracing.span(
+                "probe",
+                clip=os.path.splitext(os.path.basename(origy4m))[0],
+                bytes=orig_file_size):
+            header = y4m.probe(origy4m)
+    except ValueError as exc:
+        sys.stderr.write("Failed to probe {}: {}\n".format(origy4m, exc))
+        sys.exit(1)
+    width = header['width']
+    height = header['height']
+    frames = header['frames']
+    return {
+        'origy4m': origy4m,
+        'orig_file_size': orig_file_size,
+        'width': width,
+        'height': height,
+        'frames': frames,
+        'pixels': width * height * frames
+    }
+
+
+# Encodes, decodes and scores one (clip, quality) point, and returns the
+# corresponding line of the results file.
+def process_point(args):
+    [format, format_recipe, subset_name, clip, quality, threads] = args
+    origy4m = clip['origy4m']
+    frames = clip['frames']
+    pixels = clip['pixels']
+    preview = clip.get('preview')
+
+    print("Processing video {}, format {}, quality {}".format(
+        os.path.basename(origy4m), format, quality))
+    try:
+        with tracing.tagged(
+                format=format,
+                clip=os.path.splitext(os.path.basename(origy4m))[0],
+                quality=quality), tracing.span("point"):
+            with prepared_source(origy4m, preview) as (
+                    origy4m_10bits, reference_y4m, reference_yuv):
+                scorers = get_scorers(origy4m, reference_y4m, reference_yuv,
+                                      clip['width'], clip['height'], preview)
+                with staging.staged(
+                        staging_tiers,
+                        get_staging_size(clip, format_recipe,
+                                         scorers)) as staging_dir:
+                    results = get_lossy_results(
+                        subset_name, origy4m, origy4m_10bits, reference_yuv,
+                        clip['width'], clip['height'], format, format_recipe,
+                        quality, threads, scorers, staging_dir, preview)
+    except SystemExit as exc:
+        # run_silent exits on failure, which would kill the pool worker
+        # without ever reporting back to the scheduler.
+        raise RuntimeError("Processing of {}, quality {} failed".format(
+            os.path.basename(origy4m), quality)) from exc
+
+    row = {
+        'file_name': os.path.splitext(os.path.basename(origy4m))[0],
+        'quality': quality,
+        'orig_file_size': clip['orig_file_size'],
+        'compressed_file_size': results[0],
+        'height': clip['height'],
+        'frames': frames,
+        'pixels': pixels,
+        'bpp': results[0] * 8 / pixels,
+        'compression_ratio': clip['orig_file_size'] / results[0],
+        'y_ssim_score': results[3],
+        'rgb_ssim_score': results[4],
+        'msssim_score': results[5],
+        'psnrhvsm_score': results[6],
+        'vmaf_score': results[7]
+    }
+    for (stage, timing) in (("encode", results[1]), ("decode", results[2])):
+        for key in timing:
+            row[stage + "_" + key] = timing[key]
+        row[stage + "_fpm"] = frames / timing['time'] * 60
+    return format_result(row)
+
+
+# Returns the line of the results file of a point pruned by a stop rule,
+# which was neither encoded nor scored
+def get_pruned_result(clip, quality):
+    return format_result({
+        'file_name': os.path.splitext(os.path.basename(clip['origy4m']))[0],
+        'quality': quality,
+        'orig_file_size': clip['orig_file_size'],
+        'height': clip['height'],
+        'frames': clip['frames'],
+        'pixels': clip['pixels']
+    })
+
+
+# The columns missing from the row, like those of a pruned point, are NaN
+def format_result(row):
+    values = []
+    for column in results_store.result_columns:
+        if column not in row:
+            values.append("nan")
+        elif column == "file_name":
+            values.append(row[column])
+        elif column in results_store.integer_columns:
+            values.append("%d" % row[column])
+        else:
+            values.append("%f" % row[column])
+    return ":".join(values) + "\n"
+
+
+# The results file is only created once complete, by renaming it into place
+def write_results(path, lines):
+    create_dir(path)
+    file = open(path + ".tmp", "w")
+    file.write(":".join(results_store.result_columns) + "\n")
+    for line in lines:
+        file.write(line)
+    file.flush()
+    os.fsync(file.fileno())
     file.close()
+    os.replace(path + ".tmp", path)
+
+
+# Writes the results file of a clip, and adds its results to the store of
+# the subset unless they are those of a preview
+def save_results(subset_name, format, result_file, lines, preview=None):
+    rows = [parse_result(line) for line in lines]
+    with tracing.span("save results", format=format,
+                      clip=rows[0]['file_name']):
+        write_results(result_file, lines)
+        if preview is None:
+            results_store.insert_results(
+                results_store.get_store_file("results/" + subset_name),
+                format, rows[0]['file_name'], rows)
+
+
+# The journal of a results file records every completed point, so that an
+# interrupted run only has to process the missing ones. Each point is a JSON
+# line appended with a single write; a torn last line is ignored.
+def get_journal_file(result_file):
+    return os.path.splitext(result_file)[0] + ".journal"
+
+
+def quality_key(quality):
+    return "%f" % quality
+
+
+def read_journal(path):
+    points = {}
+    try:
+        with open(path) as journal:
+            for entry in journal:
+                if not entry.endswith("\n"):
+                    break
+                try:
+                    point = json.loads(entry)
+                except ValueError:
+                    continue
+                points[point['quality']] = point['line']
+    except FileNotFoundError:
+        pass
+    return points
+
+
+def append_journal(path, quality, line):
+    create_dir(path)
+    entry = json.dumps({'quality': quality_key(quality), 'line': line}) + "\n"
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, entry.encode("utf-8"))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Runs the (clip, quality) jobs in a pool of workers, without taking more
+# than cpu_budget CPU slots at once. Each job is a tuple
+# (threads, func, args, on_result): func(args) is run in a worker, and
+# on_result(result) is called in the main process once it is done. It may
+# return a list of new jobs, which are run before the pending ones.
+def run_jobs(jobs, cpu_budget, settings):
+    global cpu_slots
+    pending = list(jobs)
+    running = 0
+    done = queue.Queue()
+
+    def submit(pool, job):
+        (threads, func, args, on_result) = job
+        pool.apply_async(
+            func, (args, ),
+            callback=lambda result: done.put((job, result, None)),
+            error_callback=lambda exc: done.put((job, None, exc)))
+
+    # The workers may borrow the slots left free by the scheduler, to run
+    # the metrics of their job concurrently.
+    cpu_slots = Value('i', cpu_budget)
+    pool = Pool(
+        processes=cpu_budget,
+        initializer=init_worker,
+        initargs=(cpu_slots, settings))
+    while pending or running:
+        # Start the pending jobs in order, as long as they fit in the free
+        # slots. The jobs after the first one that does not fit wait for it,
+        # so that a job taking the whole budget is not kept waiting forever
+        # by smaller ones.
+        while pending and take_slots(pending[0][0]):
+            job = pending.pop(0)
+            running += 1
+            submit(pool, job)
+
+        (job, result, exc) = done.get()
+        running -= 1
+        release_slots(job[0])
+        if exc is not None:
+            pool.terminate()
+            staging.remove_stale(staging_tiers)
+            sys.stderr.write("{}\n".format(exc))
+            sys.stderr.write("Aborting!\n")
+            sys.exit(1)
+        new_jobs = job[3](result)
+        if new_jobs:
+            pending[0:0] = new_jobs
+
+    pool.close()
+    pool.join()
+
+
+# Runs the jobs of run_jobs() on the workers of a shared job queue instead of
+# a local pool: the jobs are published in queue_dir, and on_result is called
+# in the coordinator as their results come back.
+def run_queue(jobs, queue_dir, settings):
+    run_id = "%x" % time.time_ns()
+    outstanding = {}
+    requeued = set()
+    count = itertools.count()
+
+    def publish(job):
+        job_id = "%s-%08d" % (run_id, next(count))
+        outstanding[job_id] = job
+        job_queue.publish(queue_dir, job_id, job[0], job[2])
+
+    job_queue.create_queue(queue_dir, {'settings': settings, 'lease': lease})
+    try:
+        for job in jobs:
+            publish(job)
+        while outstanding:
+            results = job_queue.collect(queue_dir)
+            for (job_id, result, error) in results:
+                job = outstanding.pop(job_id, None)
+                if job is None:
+                    continue
+                if job_id in requeued:
+                    job_queue.discard(queue_dir, job_id)
+                if error is not None:
+                    sys.stderr.write("{}\n".format(error))
+                    sys.stderr.write("Aborting!\n")
+                    sys.exit(1)
+                for new_job in job[3](result) or []:
+                    publish(new_job)
+            for job_id in job_queue.requeue_expired(queue_dir, lease):
+                print("Job {} missed its lease, requeued.".format(job_id))
+                requeued.add(job_id)
+            if not results:
+                time.sleep(poll_interval)
+    finally:
+        job_queue.close_queue(queue_dir)
+
+
+# Processes the jobs of a shared job queue with up to cpu_budget CPU slots,
+# until the coordinator closes the queue
+def run_worker(queue_dir, cpu_budget):
+    global cpu_slots
+    description = job_queue.read_queue(queue_dir)
+    while description is None:
+        time.sleep(poll_interval)
+        description = job_queue.read_queue(queue_dir)
+    worker = job_queue.get_worker_id()
+    claims = itertools.count()
+    claimed = {}
+    done = queue.Queue()
+    stop = threading.Event()
+
+    # Each worker has its own trace, next to the one of the coordinator
+    settings = dict(description['settings'])
+    if 'trace_file' in settings:
+        settings['trace_file'] += "." + worker
+        tracing.create(settings['trace_file'])
+
+    def refresh():
+        while not stop.wait(description['lease'] / 10):
+            job_queue.heartbeat(list(claimed))
+
+    cpu_slots = Value('i', cpu_budget)
+    pool = Pool(
+        processes=cpu_budget,
+        initializer=init_worker,
+        initargs=(cpu_slots, settings))
+    heartbeat = threading.Thread(target=refresh, daemon=True)
+    heartbeat.start()
+    try:
+        while True:
+            # Claim the pending jobs in order, as long as they fit in the
+            # free slots, like run_jobs()
+            if cpu_slots.value > 0:
+                for (name, threads) in job_queue.list_pending(queue_dir):
+                    threads = min(threads, cpu_budget)
+                    if not take_slots(threads):
+                        break
+                    job = job_queue.claim(queue_dir, name,
+                                          "%s-%d" % (worker, next(claims)))
+                    if job is None:
+                        release_slots(threads)
+                        continue
+                    (path, args) = job
+                    claimed[path] = threads
+                    pool.apply_async(
+                        process_point, (args, ),
+                        callback=lambda result, path=path: done.put(
+                            (path, result, None)),
+                        error_callback=lambda exc, path=path: done.put(
+                            (path, None, str(exc))))
+
+            if not claimed and job_queue.is_closed(queue_dir):
+                break
+            try:
+                (path, result, error) = done.get(timeout=poll_interval)
+            except queue.Empty:
+                continue
+            release_slots(claimed.pop(path))
+            job_queue.complete(queue_dir, path, result, error)
+    finally:
+        stop.set()
+        pool.terminate()
+        pool.join()
+        staging.remove_stale(staging_tiers)
+        if tracing.is_enabled():
+            print("Stages taking the most time (trace in {}):".format(
+                settings['trace_file']))
+            tracing.print_summary(tracing.finish())
+
+
+def parse_result(line):
+    values = line.rstrip("\n").split(":")
+    return dict(
+        zip(results_store.result_columns,
+            [values[0]] + [float(value) for value in values[1:]]))
+
+
+# Adaptive quality search: instead of every quality of the recipe, only the
+# points needed to get search['points'] results evenly spread over
+# [search['low'], search['high']] of search['metric'], a column of the
+# results, are encoded. The bpp are spread evenly on a log scale, like they
+# are plotted.
+def get_search_targets(search):
+    if search['metric'] == "bpp":
+        return list(np.geomspace(search['low'], search['high'], search['points']))
+    return list(np.linspace(search['low'], search['high'], search['points']))
+
+
+# The qualities the adaptive search can select: every integer quality from
+# the first to the last of the recipe, and not only its steps, so that the
+# targets land on distinct qualities. The recipes with float qualities keep
+# their steps.
+def get_search_quality_list(quality_list):
+    if not all(isinstance(quality, int) for quality in quality_list):
+        return quality_list
+    if len(quality_list) < 2:
+        return quality_list
+    step = 1 if quality_list[-1] > quality_list[0] else -1
+    return list(range(quality_list[0], quality_list[-1] + step, step))
+
+
+# Given the values of the search metric measured so far for each quality of
+# the search (None if not measured), returns the indexes of the qualities to
+# measure next, or, once the search is over, of the quality selected for each
+# target. The search starts from a coarse probe of both ends and the middle
+# of the quality range, then refines each target by interpolation between the
+# measured qualities bracketing it, until a measured point is close enough or
+# there is no quality left between the brackets.
+def plan_search(values, search, targets):
+    if search['metric'] == "bpp":
+        scale = np.log
+    else:
+        scale = float
+    measured = [i for i, value in enumerate(values) if value is not None]
+    probes = set([0, (len(values) - 1) // 2, len(values) - 1])
+    if not probes.issubset(measured):
+        return (sorted(probes.difference(measured)), None)
+
+    # Close enough: a quarter of the gap between two targets
+    tolerance = abs(scale(targets[-1]) - scale(targets[0])) / (
+        4 * max(len(targets) - 1, 1))
+    next_list = set()
+    selected = []
+    for target in targets:
+        t = scale(target)
+        # Every target gets its own point: the closest one not selected for
+        # a previous target, or a new quality next to the previous one when
+        # they are all taken
+        candidates = [i for i in measured if i not in selected]
+        if not candidates:
+            unmeasured = [i for i, value in enumerate(values) if value is None]
+            if unmeasured:
+                next_list.add(
+                    min(unmeasured, key=lambda i: abs(i - selected[-1])))
+            continue
+        best = min(candidates, key=lambda i: abs(scale(values[i]) - t))
+        selected.append(best)
+        if abs(scale(values[best]) - t) <= tolerance:
+            continue
+        for (a, b) in zip(measured, measured[1:]):
+            (va, vb) = (scale(values[a]), scale(values[b]))
+            if va == vb or not min(va, vb) <= t <= max(va, vb):
+                continue
+            if b - a > 1:
+                guess = int(round(a + (t - va) / (vb - va) * (b - a)))
+                next_list.add(min(max(guess, a + 1), b - 1))
+            break
+
+    if next_list:
+        return (sorted(next_list), None)
+    return ([], selected)
+
+
+# Returns the jobs of the next round of the adaptive search of a clip. The
+# jobs of the following round are returned by the last job of the round, and
+# the results file is written, in target order, once the search is over.
+def get_search_jobs(format, format_recipe, subset_name, clip, quality_list,
+                    threads, search, result_file, journal_file, lines):
+    targets = get_search_targets(search)
+    pending = []
+
+    def on_result(line, i):
+        append_journal(journal_file, quality_list[i], line)
+        lines[i] = line
+        pending.remove(i)
+        if not pending:
+            return next_jobs()
+        return None
+
+    def next_jobs():
+        values = [
+            None if line is None else parse_result(line)[search['metric']]
+            for line in lines
+        ]
+        (next_list, selected) = plan_search(values, search, targets)
+        if selected is not None:
+            save_results(subset_name, format, result_file,
+                         [lines[i] for i in selected], clip.get('preview'))
+            if os.path.isfile(journal_file):
+                os.remove(journal_file)
+            return []
+
+        pending.extend(next_list)
+        return [(threads, process_point,
+                 (format, format_recipe, subset_name, clip, quality_list[i],
+                  threads), lambda line, i=i: on_result(line, i))
+                for i in next_list]
+
+    return next_jobs()
+
+
+# Early termination of the quality sweeps. The stop_rules of a recipe are
+# checked on the results of each clip after every point, in sweep order, and
+# once one of them holds the points left are pruned instead of encoded. A
+# rule on a column of the results holds when the last value is below its
+# 'min' or above its 'max', or when the column changed by less than
+# 'min_gain' over the last 'steps' points (1 by default).
+def should_stop(rules, rows):
+    for rule in rules:
+        values = [row[rule['column']] for row in rows]
+        if 'min' in rule and values[-1] < rule['min']:
+            return True
+        if 'max' in rule and values[-1] > rule['max']:
+            return True
+        steps = int(rule.get('steps', 1))
+        if ('min_gain' in rule and len(values) > steps
+                and abs(values[-1] - values[-1 - steps]) < rule['min_gain']):
+            return True
+    return False
+
+
+def check_stop_rules(format_recipe):
+    if format_recipe.get('sweep_order', "ascending") not in ("ascending",
+                                                              "descending"):
+        return False
+    for rule in format_recipe.get('stop_rules', []):
+        if (rule.get('column') not in results_store.result_columns[1:]
+                or not set(rule).intersection(("min", "max", "min_gain"))
+                or int(rule.get('steps', 1)) < 1):
+            return False
+    return True
+
+
+# Returns the job of the next point of the quality sweep of a clip, one point
+# at a time in sweep order. Once a stop rule holds or every point is done,
+# the missing points are recorded as pruned and the results file is written,
+# in quality order.
+def get_sweep_jobs(format, format_recipe, subset_name, clip, quality_list,
+                   threads, result_file, journal_file, lines):
+    order = list(range(len(quality_list)))
+    if format_recipe.get('sweep_order', "ascending") == "descending":
+        order.reverse()
+
+    def on_result(line, i):
+        append_journal(journal_file, quality_list[i], line)
+        lines[i] = line
+        return next_jobs()
+
+    def next_jobs():
+        rows = []
+        for i in order:
+            if lines[i] is None:
+                return [(threads, process_point,
+                         (format, format_recipe, subset_name, clip,
+                          quality_list[i], threads),
+                         lambda line, i=i: on_result(line, i))]
+            rows.append(parse_result(lines[i]))
+            if should_stop(format_recipe['stop_rules'], rows):
+                break
+
+        pruned = [i for i in order if lines[i] is None]
+        if pruned:
+            print("Pruned {} points of video {}, format {}.".format(
+                len(pruned), os.path.basename(clip['origy4m']), format))
+        for i in pruned:
+            lines[i] = get_pruned_result(clip, quality_list[i])
+        save_results(subset_name, format, result_file, lines,
+                     clip.get('preview'))
+        if os.path.isfile(journal_file):
+            os.remove(journal_file)
+        return []
+
+    return next_jobs()
+
+
+# Returns the jobs of the points of a format still missing from its results
+# files. Every point of a clip is an independent job, journaled as soon as
+# it is done. The results file of a clip is written once all of them are
+# done, in quality order. The points of the recipes with stop rules are
+# rather swept one after the other, each clip on its own.
+def get_format_jobs(format, format_recipe, subset_name, clip_list,
+                    cpu_budget, search=None):
+    quality_list = get_quality_list(format_recipe)
+    if quality_list is None:
+        return None
+    if not check_stop_rules(format_recipe):
+        print('There was an error parsing the stop rules of the format recipe.')
+        return None
+    threads = get_job_threads(format_recipe, cpu_budget)
+
+    jobs = []
+    for clip in clip_list:
+        result_file = get_result_file(subset_name, format, clip['origy4m'],
+                                      clip.get('preview'))
+        if os.path.isfile(result_file) and not os.stat(result_file).st_size < 182:
+            continue
+        journal_file = get_journal_file(result_file)
+        journal = read_journal(journal_file)
+        lines = [journal.get(quality_key(quality)) for quality in quality_list]
+
+        if search is not None:
+            search_list = get_search_quality_list(quality_list)
+            jobs += get_search_jobs(
+                format, format_recipe, subset_name, clip, search_list,
+                threads, search, result_file, journal_file,
+                [journal.get(quality_key(quality)) for quality in search_list])
+            continue
+        if 'stop_rules' in format_recipe:
+            jobs += get_sweep_jobs(format, format_recipe, subset_name, clip,
+                                   quality_list, threads, result_file,
+                                   journal_file, lines)
+            continue
+
+        def finish(result_file=result_file, journal_file=journal_file,
+                   lines=lines, preview=clip.get('preview')):
+            save_results(subset_name, format, result_file, lines, preview)
+            if os.path.isfile(journal_file):
+                os.remove(journal_file)
+
+        if None not in lines:
+            finish()
+            continue
+
+        for i, quality in enumerate(quality_list):
+            if lines[i] is not None:
+                continue
+
+            def on_result(line, journal_file=journal_file, lines=lines, i=i,
+                          quality=quality, finish=finish):
+                append_journal(journal_file, quality, line)
+                lines[i] = line
+                if None not in lines:
+                    finish()
+
+            jobs.append((threads, process_point,
+                         (format, format_recipe, subset_name, clip, quality,
+                          threads),
+                         on_result))
+    return jobs
+
+
+def read_results(result_file):
+    with open(result_file) as f:
+        return [parse_result(line) for line in f.readlines()[1:]]
+
+
+# Compares, for each format, the results of the preview of the calibration
+# clip to its full results at the same qualities. The errors of the preview
+# on each metric are printed, and written to
+# results/<subset>/<format>/preview/<clip>.calibration.out
+def report_calibration(subset_name, formats, origy4m, preview):
+    print("Error of the preview {} against the full results of {}:".format(
+        preview, os.path.basename(origy4m)))
+    print("{:<12} {:<16} {:>12} {:>12} {:>12}".format(
+        "Format", "Metric", "Mean", "Mean abs", "Max abs"))
+    for format in formats:
+        full_file = get_result_file(subset_name, format, origy4m)
+        preview_file = get_result_file(subset_name, format, origy4m, preview)
+        if not os.path.isfile(full_file) or not os.path.isfile(preview_file):
+            continue
+        full = {row['quality']: row for row in read_results(full_file)}
+        previewed = {row['quality']: row for row in read_results(preview_file)}
+        # The points pruned by a stop rule are not compared
+        qualities = sorted(
+            quality for quality in set(full).intersection(previewed)
+            if not np.isnan(full[quality]['compressed_file_size'])
+            and not np.isnan(previewed[quality]['compressed_file_size']))
+        if not qualities:
+            continue
+
+        lines = ["metric:mean_error:mean_absolute_error:max_absolute_error\n"]
+        for column in results_store.result_columns:
+            if not column.endswith("_score"):
+                continue
+            # Equal scores have no error, even when infinite
+            errors = np.array([
+                0 if previewed[quality][column] == full[quality][column] else
+                previewed[quality][column] - full[quality][column]
+                for quality in qualities
+            ])
+            (mean, mean_abs, max_abs) = (np.mean(errors),
+                                         np.mean(np.abs(errors)),
+                                         np.max(np.abs(errors)))
+            print("{:<12} {:<16} {:>12.4f} {:>12.4f} {:>12.4f}".format(
+                format, column, mean, mean_abs, max_abs))
+            lines.append("%s:%f:%f:%f\n" % (column, mean, mean_abs, max_abs))
+
+        calibration_file = os.path.splitext(preview_file)[0] + \
+            ".calibration.out"
+        with open(calibration_file + ".tmp", "w") as f:
+            f.writelines(lines)
+        os.replace(calibration_file + ".tmp", calibration_file)
 
 
 def main(argv):
@@ -384,26 +1520,202 @@ def main(argv):
 
     supported_formats = list(data['recipes'].keys())
 
-    if len(argv) != 4:
+    # Module settings overridden on the command line, and forwarded to the
+    # workers
+    settings = {}
+    cpu_budget = os.cpu_count()
+    search = None
+    queue_dir = None
+    worker_dir = None
+    preview = None
+    calibration = None
+    try:
+        opts, args = getopt.getopt(
+            argv[1:], "j:",
+            ["jobs=", "stream", "native=", "adaptive=", "repeat=", "frames",
+             "reencode", "queue=", "worker=", "lease=", "trace=", "preview=",
+             "calibration="])
+        for opt, value in opts:
+            if opt in ("-j", "--jobs"):
+                cpu_budget = int(value)
+            elif opt == "--stream":
+                settings['stream'] = True
+            elif opt == "--native":
+                settings['native_metrics'] = value.split(",")
+            elif opt == "--repeat":
+                settings['repeat'] = int(value)
+            elif opt == "--frames":
+                settings['capture_frames'] = True
+            elif opt == "--reencode":
+                settings['reencode'] = True
+            elif opt == "--queue":
+                queue_dir = value
+            elif opt == "--worker":
+                worker_dir = value
+            elif opt == "--lease":
+                globals()['lease'] = int(value)
+            elif opt == "--trace":
+                settings['trace_file'] = value
+            elif opt == "--preview":
+                # Raises ValueError if invalid
+                get_preview_frames(value, 1)
+                preview = value
+            elif opt == "--calibration":
+                calibration = value
+            elif opt == "--adaptive":
+                (metric, low, high, points) = value.split(":")
+                search = {
+                    'metric': metric,
+                    'low': float(low),
+                    'high': float(high),
+                    'points': int(points)
+                }
+    except (getopt.GetoptError, ValueError):
+        args = []
+
+    if worker_dir is not None and not args and cpu_budget >= 1:
+        run_worker(worker_dir, cpu_budget)
+        return
+
+    if search is not None and (
+            search['metric'] not in results_store.result_columns[1:]
+            or search['points'] < 1):
+        args = []
+
+    if calibration is not None and preview is None:
+        args = []
+
+    if len(args) != 3 or cpu_budget < 1 or settings.get('repeat', 1) < 1:
         print(
-            "rd_collect.py: Generate compressed videos from Y4M and calculate quality and speed metrics for a given format"
+            "rd_collect.py: Generate compressed videos from Y4M and calculate quality and speed metrics for the given formats"
         )
-        print("Arg 1: format to test {}".format(supported_formats))
+        print("Arg 1: comma-separated formats to test, or 'all' {}".format(
+            supported_formats))
         print("Arg 2: name of the subset to test (e.g. 'subset1')")
         print("Arg 3: path to the subset to test (e.g. 'subset1/')")
+        print("Option -j, --jobs: number of CPU cores to use (default: {})".
+              format(os.cpu_count()))
+        print("Option --stream: pipe the decoded videos to the metrics")
+        print("Option --native: comma-separated metrics to compute in-process "
+              "(y_ssim, msssim)")
+        print("Option --repeat: number of times the encoder and the decoder "
+              "are run to time them (default: 1)")
+        print("Option --frames: keep the per-frame scores of every metric")
+        print("Option --reencode: encode every point again, even when its "
+              "bitstream is in the encode cache")
+        print("Option --queue=dir: publish the jobs in a job queue shared "
+              "with the workers, instead of running them")
+        print("Option --worker=dir: process the jobs of a job queue, "
+              "without other arguments")
+        print("Option --lease: seconds after which the job of an "
+              "unresponsive worker is requeued (default: {})".format(lease))
+        print("Option --trace=file: write the time spent in each stage as a "
+              "Chrome trace")
+        print("Option --preview=every:N or windows:count:length: only score "
+              "every Nth frame, or count windows of length frames, and keep "
+              "the results apart")
+        print("Option --calibration=clip: with --preview, also process this "
+              "clip of the subset in full, and report the error of its "
+              "preview")
+        print("Option --adaptive=metric:low:high:points: only encode the "
+              "qualities giving points evenly spread over [low, high] of a "
+              "results column (e.g. bpp:0.01:0.6:8 or vmaf_score:80:99:8)")
         return
 
-    format = argv[1]
-    subset_name = argv[2]
-    if format not in supported_formats:
-        print("Video format not supported. Supported formats are: {}.".format(
-            supported_formats))
-        return
+    for metric in settings.get('native_metrics', []):
+        if metric not in native_scales:
+            print("Metric {} has no native implementation.".format(metric))
+            return
 
-    pool = Pool(processes=1)
-    pool.map(process_image, [(format, data['recipes'][format], subset_name,
-                                origy4m)
-                               for origy4m in glob.glob(argv[3] + "/*.y4m")])
+    subset_name = args[1]
+    if args[0] == "all":
+        formats = supported_formats
+    else:
+        formats = [format.strip() for format in args[0].split(",")]
+    for format in formats:
+        if format not in supported_formats:
+            print("Video format not supported. Supported formats are: {}.".
+                  format(supported_formats))
+            return
+
+    # Clips still missing results for at least one format, probed once
+    clip_list = []
+    for origy4m in glob.glob(args[2] + "/*.y4m"):
+        for format in formats:
+            result_file = get_result_file(subset_name, format, origy4m,
+                                          preview)
+            if not os.path.isfile(result_file) or os.stat(result_file).st_size < 182:
+                clip_list.append((origy4m, preview))
+                break
+
+    # The calibration clip of a preview also needs its full results
+    if calibration is not None:
+        calibration_y4m = os.path.join(args[2], calibration)
+        if not calibration_y4m.endswith(".y4m"):
+            calibration_y4m += ".y4m"
+        if not os.path.isfile(calibration_y4m):
+            print("Could not find the calibration clip {}.".format(
+                calibration_y4m))
+            return
+        for format in formats:
+            result_file = get_result_file(subset_name, format,
+                                          calibration_y4m)
+            if not os.path.isfile(result_file) or os.stat(result_file).st_size < 182:
+                clip_list.append((calibration_y4m, None))
+                break
+
+    if 'trace_file' in settings:
+        tracing.create(settings['trace_file'])
+    try:
+        clip_list = [
+            dict(probe_image(origy4m), preview=clip_preview)
+            for (origy4m, clip_preview) in clip_list
+        ]
+
+        # The scores of the tools and of the native metrics differ slightly,
+        # so a clip too small for a native metric is not scored by its tool
+        # instead, which would average both together
+        too_small = [
+            os.path.basename(clip['origy4m']) for clip in clip_list
+            if not all(
+                metrics.fits(clip, native_scales[metric])
+                for metric in settings.get('native_metrics', []))
+        ]
+        if too_small:
+            print("Clips too small for the native metrics {} (at least {} "
+                  "pixels on a side): {}.".format(
+                      ",".join(settings['native_metrics']),
+                      max(metrics.window_size << (native_scales[metric] - 1)
+                          for metric in settings['native_metrics']),
+                      ", ".join(sorted(set(too_small)))))
+            return
+
+        format_jobs = []
+        for format in formats:
+            jobs = get_format_jobs(format, data['recipes'][format],
+                                   subset_name, clip_list, cpu_budget, search)
+            if jobs is None:
+                return
+            format_jobs.append(jobs)
+
+        # Interleave the formats, so that the cores left by a slow encoder
+        # are used by the jobs of the others
+        jobs = [
+            job for jobs in itertools.zip_longest(*format_jobs) for job in jobs
+            if job is not None
+        ]
+        if queue_dir is not None:
+            run_queue(jobs, queue_dir, settings)
+        else:
+            run_jobs(jobs, cpu_budget, settings)
+
+        if calibration is not None:
+            report_calibration(subset_name, formats, calibration_y4m, preview)
+    finally:
+        if tracing.is_enabled():
+            print("Stages taking the most time (trace in {}):".format(
+                settings['trace_file']))
+            tracing.print_summary(tracing.finish())
 
 
 if __name__ == "__main__":
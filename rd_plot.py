@@ -31,252 +31,255 @@
 import os
 import sys
 import glob
+import json
+import hashlib
 import numpy as np
 import pandas as pd
 import six
+import getopt
 import pytablewriter
+import results_store
+from multiprocessing import Pool
 import matplotlib
 matplotlib.use('Cairo')
 import matplotlib.pyplot as plt
 
 
-def generate_plots(path, requested_formats):
+# Figures drawn for each resolution: the column of each axis, with its
+# label, limits and scale, and the degree of the polynomial fitted to the
+# points, if any.
+plots = [
+    {"name": "y-ssim",
+     "title": "Quality according to Y-SSIM in function of number of bits per pixel",
+     "x": "avg_bpp", "xlabel": "Bits per pixels", "xscale": "log", "xlim": [0.01, 0.6],
+     "y": "wavg_y_ssim_score", "ylabel": "dB (Y-SSIM)", "ylim": [10, 20]},
+    {"name": "rgb-ssim",
+     "title": "Quality according to RGB-SSIM in function of number of bits per pixel",
+     "x": "avg_bpp", "xlabel": "Bits per pixels", "xscale": "log", "xlim": [0.01, 0.6],
+     "y": "wavg_rgb_ssim_score", "ylabel": "dB (RGB-SSIM)", "ylim": [10, 20]},
+    {"name": "ms-ssim",
+     "title": "Quality according to MS-SSIM in function of number of bits per pixel",
+     "x": "avg_bpp", "xlabel": "Bits per pixels", "xscale": "log", "xlim": [0.01, 0.6],
+     "y": "wavg_msssim_score", "ylabel": "dB (MS-SSIM)", "ylim": [10, 30]},
+    {"name": "psnr-hvs-m",
+     "title": "Quality according to PSNR-HVS-M in function of number of bits per pixel",
+     "x": "avg_bpp", "xlabel": "Bits per pixels", "xscale": "log", "xlim": [0.01, 0.6],
+     "y": "wavg_psnrhvsm_score", "ylabel": "dB (PSNR-HVS-M)", "ylim": [25, 50]},
+    {"name": "vmaf",
+     "title": "Quality according to VMAF in function of number of bits per pixel",
+     "x": "avg_bpp", "xlabel": "Bits per pixels", "xscale": "log", "xlim": [0.01, 0.6],
+     "y": "wavg_vmaf_score", "ylabel": "Score (VMAF)", "ylim": [80, 100]},
+    {"name": "encoding_fpm",
+     "title": "Speed in function of average bpp",
+     "x": "avg_bpp", "xlabel": "Bits per pixel", "xscale": "log", "xlim": [0.01, 0.6],
+     "y": "wavg_encode_fpm", "ylabel": "Frames per minute", "ylim": [0, 600]},
+    {"name": "encoding_fpm_to_vmaf",
+     "title": "Encoding time in function of VMAF quality",
+     "x": "wavg_vmaf_score", "xlabel": "Score (VMAF)", "xlim": [80, 100],
+     "y": "wavg_encode_fpm", "ylabel": "Frames per minute", "ylim": [0, 600]},
+    {"name": "vmaf_to_crf",
+     "title": "VMAF in function of crf",
+     "x": "quality", "xlabel": "Quality (crf)", "xlim": [10, 60],
+     "y": "wavg_vmaf_score", "ylabel": "VMAF score", "ylim": [90, 100],
+     "fit": 4},
+]
 
-    # Get list of resolutions
-    rawdata = []
-    resolution_list = []
-    
-    data_path = path + "/" + requested_formats[0] + "/lossy/"
-    
-    for f in glob.glob(data_path + "*.out"):
-        rawdata.append(pd.read_csv(f, sep=":"))
+# File formats of the figures
+image_formats = ["svg", "png"]
 
-    for data in rawdata:
-        resolution_list = resolution_list + data["height"][data.index == 1].tolist()
-    resolution_list = list(set(resolution_list)) + ["any"]
-    rawdata = []
-    
+plt.rcParams['svg.fonttype'] = 'none'
+plt.rcParams['axes.axisbelow'] = True
+
+
+def get_average_file(path, format, resolution):
+    return path + "/" + os.path.basename(path) + "." + format + "." + str(
+        resolution) + ".lossy.out"
+
+
+def load_averages(path, requested_formats, resolution):
+    data = {}
+    for format in requested_formats:
+        data[format] = pd.read_csv(
+            get_average_file(path, format, resolution), sep=":")
+    return data
+
+
+def get_figure_file(path, resolution, requested_formats, plot, image_format):
+    return path + "/" + os.path.basename(path) + "." + plot["name"] + "." + str(
+        resolution) + ".(" + ','.join(requested_formats) + ")." + image_format
+
+
+# The manifest of the figures and tables of a subset keeps, for each of them,
+# the hash of what it was generated from
+def get_manifest_file(path):
+    return path + "/" + os.path.basename(path) + ".plots.json"
+
+
+def read_manifest(path):
+    try:
+        with open(get_manifest_file(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(path, manifest):
+    manifest_file = get_manifest_file(path)
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+# Returns the hash of the averages of the formats for a resolution, and of
+# the description of the output generated from them
+def get_inputs_hash(path, requested_formats, resolution, description):
+    digest = hashlib.sha1(
+        json.dumps([description, str(resolution), requested_formats],
+                   sort_keys=True).encode("utf-8"))
+    for format in requested_formats:
+        with open(get_average_file(path, format, resolution), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def is_up_to_date(manifest, key, inputs_hash, files):
+    return manifest.get(key) == inputs_hash and all(
+        os.path.isfile(file) for file in files)
+
+
+# Draws a figure of the plots table for a resolution. Every figure is drawn
+# by its own task, and closed once saved.
+def plot_figure(args):
+    [path, resolution, requested_formats, plot, image_format] = args
     subset_name = os.path.basename(path)
-    
-    for resolution in resolution_list:
-        data = {}
-        
-        for format in requested_formats:
-            file = path + "/" + subset_name  + "." + format + "." + str(resolution) + ".lossy.out"
-            data[format] = pd.read_csv(file, sep=":")
-
-        plt.rcParams['svg.fonttype'] = 'svgfont'
-        plt.rcParams['axes.axisbelow'] = True
-
-        # Y-SSIM
-        fig = plt.figure()
-        plt.figure(figsize=(25, 15))
-        plt.title(
-            "Quality according to Y-SSIM in function of number of bits per pixel")
-        plt.suptitle(subset_name + ", resolution: " + str(resolution))
-        plt.xlabel("Bits per pixels")
-        plt.ylabel("dB (Y-SSIM)")
-        plt.xscale("log")
-        plt.xlim([0.01, 0.6])
-        plt.ylim([10, 20])
-        plt.minorticks_on()
-        plt.grid(b=True, which='both', color='0.65', linestyle='--')
-        for format in data:
-            plt.plot(
-                data[format]["avg_bpp"],
-                data[format]["wavg_y_ssim_score"],
-                '+-',
-                label=format)
-        plt.legend()
-        plt.savefig(path + "/" + subset_name + ".y-ssim." + str(resolution) +
-                    ".(" + ','.join(requested_formats) + ").svg")
-        plt.close(fig)
+    data = load_averages(path, requested_formats, resolution)
 
-        # RGB-SSIM
-        fig = plt.figure()
-        plt.figure(figsize=(25, 15))
-        plt.title(
-            "Quality according to RGB-SSIM in function of number of bits per pixel"
-        )
-        plt.suptitle(subset_name + ", resolution: " + str(resolution))
-        plt.xlabel("Bits per pixels")
-        plt.ylabel("dB (RGB-SSIM)")
-        plt.xscale("log")
-        plt.xlim([0.01, 0.6])
-        plt.ylim([10, 20])
-        plt.minorticks_on()
-        plt.grid(b=True, which='both', color='0.65', linestyle='--')
+    fig, ax = plt.subplots(figsize=(25, 15))
+    try:
+        ax.set_title(plot["title"])
+        fig.suptitle(subset_name + ", resolution: " + str(resolution))
+        ax.set_xlabel(plot["xlabel"])
+        ax.set_ylabel(plot["ylabel"])
+        if "xscale" in plot:
+            ax.set_xscale(plot["xscale"])
+        ax.set_xlim(plot["xlim"])
+        ax.set_ylim(plot["ylim"])
+        ax.minorticks_on()
+        ax.grid(True, which='both', color='0.65', linestyle='--')
         for format in data:
-            plt.plot(
-                data[format]["avg_bpp"],
-                data[format]["wavg_rgb_ssim_score"],
-                '+-',
-                label=format)
-        plt.legend()
-        plt.savefig(path + "/" + subset_name + ".rgb-ssim." + str(resolution) +
-                    ".(" + ','.join(requested_formats) + ").svg")
+            if "fit" in plot:
+                p = np.poly1d(
+                    np.polyfit(data[format][plot["x"]], data[format][plot["y"]],
+                               plot["fit"]))
+                xp = np.linspace(plot["xlim"][0], plot["xlim"][1], 100)
+                ax.plot(data[format][plot["x"]], data[format][plot["y"]], "+",
+                        xp, p(xp), "-", label=format)
+            else:
+                ax.plot(
+                    data[format][plot["x"]],
+                    data[format][plot["y"]],
+                    '+-',
+                    label=format)
+        ax.legend()
+        fig.savefig(
+            get_figure_file(path, resolution, requested_formats, plot,
+                            image_format))
+    finally:
         plt.close(fig)
 
-        # MS-SSIM
-        fig = plt.figure()
-        plt.figure(figsize=(25, 15))
-        plt.title(
-            "Quality according to MS-SSIM in function of number of bits per pixel")
-        plt.suptitle(subset_name + ", resolution: " + str(resolution))
-        plt.xlabel("Bits per pixels")
-        plt.ylabel("dB (MS-SSIM)")
-        plt.xscale("log")
-        plt.xlim([0.01, 0.6])
-        plt.ylim([10, 30])
-        plt.minorticks_on()
-        plt.grid(b=True, which='both', color='0.65', linestyle='--')
-        for format in data:
-            plt.plot(
-                data[format]["avg_bpp"],
-                data[format]["wavg_msssim_score"],
-                '+-',
-                label=format)
-        plt.legend()
-        plt.savefig(path + "/" + subset_name + ".ms-ssim." + str(resolution) +
-                    ".(" + ','.join(requested_formats) + ").svg")
-        plt.close(fig)
 
-        # PSNR-HVS-M
-        fig = plt.figure()
-        plt.figure(figsize=(25, 15))
-        plt.title(
-            "Quality according to PSNR-HVS-M in function of number of bits per pixel"
-        )
-        plt.suptitle(subset_name + ", resolution: " + str(resolution))
-        plt.xlabel("Bits per pixels")
-        plt.ylabel("dB (PSNR-HVS-M)")
-        plt.xscale("log")
-        plt.xlim([0.01, 0.6])
-        plt.ylim([25, 50])
-        plt.minorticks_on()
-        plt.grid(b=True, which='both', color='0.65', linestyle='--')
-        for format in data:
-            plt.plot(
-                data[format]["avg_bpp"],
-                data[format]["wavg_psnrhvsm_score"],
-                '+-',
-                label=format)
-        plt.legend()
-        plt.savefig(path + "/" + subset_name + ".psnr-hvs-m." +
-                    str(resolution) + ".(" + ','.join(requested_formats) +
-                    ").svg")
-        plt.close(fig)
+def generate_plots(path, requested_formats, image_format="svg", force=False):
 
-        # VMAF
-        fig = plt.figure()
-        plt.figure(figsize=(25, 15))
-        plt.title(
-            "Quality according to VMAF in function of number of bits per pixel")
-        plt.suptitle(subset_name + ", resolution: " + str(resolution))
-        plt.xlabel("Bits per pixels")
-        plt.ylabel("Score (VMAF)")
-        plt.xscale("log")
-        plt.xlim([0.01, 0.6])
-        plt.ylim([80, 100])
-        plt.minorticks_on()
-        plt.grid(b=True, which='both', color='0.65', linestyle='--')
-        for format in data:
-            plt.plot(
-                data[format]["avg_bpp"],
-                data[format]["wavg_vmaf_score"],
-                '+-',
-                label=format)
-        plt.legend()
-        plt.savefig(path + "/" + subset_name + ".vmaf." + str(resolution) +
-                    ".(" + ','.join(requested_formats) + ").svg")
-        plt.close(fig)
+    # Get list of resolutions
+    rawdata = []
+    resolution_list = []
+    
+    store_file = results_store.get_store_file(path)
+    if results_store.has_results(store_file, requested_formats[0]):
+        results_store.import_missing(path, requested_formats[0])
+        resolution_list = results_store.get_resolutions(
+            store_file, requested_formats[0])
+    else:
+        data_path = path + "/" + requested_formats[0] + "/lossy/"
 
-        # Speed
-        fig = plt.figure()
-        plt.figure(figsize=(25, 15))
-        plt.title("Speed in function of average bpp")
-        plt.suptitle(subset_name + ", resolution: " + str(resolution))
-        plt.xlabel("Bits per pixel")
-        plt.ylabel("Frames per minute")
-        plt.xscale("log")
-        plt.xlim([0.01, 0.6])
-        plt.ylim([0, 600])
-        plt.minorticks_on()
-        plt.grid(b=True, which='both', color='0.65', linestyle='--')
-        for format in data:
-            plt.plot(
-                data[format]["avg_bpp"],
-                data[format]["wavg_encode_fpm"],
-                '+-',
-                label=format)
-        plt.legend()
-        plt.savefig(path + "/" + subset_name + ".encoding_fpm." +
-                    str(resolution) + ".(" + ','.join(requested_formats) +
-                    ").svg")
-        plt.close(fig)
+        for f in glob.glob(data_path + "*.out"):
+            rawdata.append(pd.read_csv(f, sep=":"))
 
-        fig = plt.figure()
-        plt.figure(figsize=(25, 15))
-        plt.title("Encoding time in function of VMAF quality")
-        plt.suptitle(subset_name + ", resolution: " + str(resolution))
-        plt.xlabel("Score (VMAF)")
-        plt.ylabel("Frames per minute")
-        plt.xlim([80, 100])
-        plt.ylim([0, 600])
-        plt.minorticks_on()
-        plt.grid(b=True, which='both', color='0.65', linestyle='--')
-        for format in data:
-            plt.plot(
-                data[format]["wavg_vmaf_score"],
-                data[format]["wavg_encode_fpm"],
-                '+-',
-                label=format)
-        plt.legend()
-        plt.savefig(path + "/" + subset_name + ".encoding_fpm_to_vmaf." +
-                    str(resolution) + ".(" + ','.join(requested_formats) +
-                    ").svg")
-        plt.close(fig)
+        for data in rawdata:
+            resolution_list = resolution_list + data["height"][data.index == 1].tolist()
+    resolution_list = list(set(resolution_list)) + ["any"]
+    rawdata = []
+    
+    # Only the figures whose averages, formats or description changed are
+    # drawn again, unless forced
+    manifest = read_manifest(path)
+    tasks = []
+    drawn = {}
+    for resolution in resolution_list:
+        for plot in plots:
+            file = get_figure_file(path, resolution, requested_formats, plot,
+                                   image_format)
+            inputs_hash = get_inputs_hash(path, requested_formats, resolution,
+                                          dict(plot, image=image_format))
+            if force or not is_up_to_date(manifest, os.path.basename(file),
+                                          inputs_hash, [file]):
+                tasks.append((path, resolution, requested_formats, plot,
+                              image_format))
+                drawn[os.path.basename(file)] = inputs_hash
+    print("Drawing {} figures, {} are up to date.".format(
+        len(tasks),
+        len(resolution_list) * len(plots) - len(tasks)))
+    if tasks:
+        Pool().map(plot_figure, tasks)
+    manifest.update(drawn)
+    write_manifest(path, manifest)
 
-        fig = plt.figure()
-        plt.figure(figsize=(25, 15))
-        plt.title("VMAF in function of crf")
-        plt.suptitle(subset_name + ", resolution: " + str(resolution))
-        plt.xlabel("Quality (crf)")
-        plt.ylabel("VMAF score")
-        plt.xlim([10, 60])
-        plt.ylim([90, 100])
-        plt.minorticks_on()
-        plt.grid(b=True, which='both', color='0.65', linestyle='--')
-        for format in data:
-            z = np.polyfit(data[format]["quality"], data[format]["wavg_vmaf_score"], 4)
-            p = np.poly1d(z)
-            xp = np.linspace(10, 60, 100)
-            plt.plot(data[format]["quality"], data[format]["wavg_vmaf_score"], "+", xp, p(xp), "-",
-                label=format)
-        plt.legend()
-        plt.savefig(path + "/" + subset_name + ".vmaf_to_crf." +
-                    str(resolution) + ".(" + ','.join(requested_formats) +
-                    ").svg")
-        plt.close(fig)
-        
-        plt.close("all")
-        
-        if resolution == 1080:
-            # crf conversion
-            results_x264 = pd.DataFrame({"x264 crf": range(16, 25)})
-            p = np.poly1d(np.polyfit(data["x264"]["quality"], data["x264"]["avg_bpp"], 4))
-            results_x264["x264 bpp"] = results_x264.apply(lambda row: p(row["x264 crf"]), axis=1)
-            p = np.poly1d(np.polyfit(data["x264"]["quality"], data["x264"]["wavg_y_ssim_score"], 4))
-            results_x264["x264 y-ssim"] = results_x264.apply(lambda row: p(row["x264 crf"]), axis=1)
-            p = np.poly1d(np.polyfit(data["x264"]["quality"], data["x264"]["wavg_rgb_ssim_score"], 4))
-            results_x264["x264 rgb-ssim"] = results_x264.apply(lambda row: p(row["x264 crf"]), axis=1)
-            p = np.poly1d(np.polyfit(data["x264"]["quality"], data["x264"]["wavg_msssim_score"], 4))
-            results_x264["x264 ms-ssim"] = results_x264.apply(lambda row: p(row["x264 crf"]), axis=1)
-            p = np.poly1d(np.polyfit(data["x264"]["quality"], data["x264"]["wavg_psnrhvsm_score"], 4))
-            results_x264["x264 psnr-hvs-m"] = results_x264.apply(lambda row: p(row["x264 crf"]), axis=1)
-            p = np.poly1d(np.polyfit(data["x264"]["quality"], data["x264"]["wavg_vmaf_score"], 4))
-            results_x264["x264 vmaf"] = results_x264.apply(lambda row: p(row["x264 crf"]), axis=1)
+    # The crf conversion table of x264, and those of each format, which only
+    # depend on the averages of x264 and of the format
+    crf_conversion_tables = {
+        "crf_conversion.x264.1080": (["x264"], [
+            path + "/" + os.path.basename(path) +
+            ".crf_conversion.x264.1080.lossy." + extension
+            for extension in ("out", "md")
+        ])
+    }
+    for format in requested_formats:
+        crf_conversion_tables[format + ".crf_conversion.1080"] = (
+            ["x264", format], [
+                path + "/" + os.path.basename(path) + "." + format +
+                ".crf_conversion.1080.lossy." + extension
+                for extension in ("out", "md")
+            ])
+    stale = {}
+    if 1080 in resolution_list:
+        for (key, (formats, files)) in crf_conversion_tables.items():
+            inputs_hash = get_inputs_hash(path, formats, 1080,
+                                          "crf_conversion")
+            if force or not is_up_to_date(manifest, key, inputs_hash, files):
+                stale[key] = inputs_hash
+    if stale:
+        data = load_averages(path, ["x264"] + [
+            format for format in requested_formats
+            if format + ".crf_conversion.1080" in stale
+        ], 1080)
+
+        # crf conversion
+        results_x264 = pd.DataFrame({"x264 crf": range(16, 25)})
+        p = np.poly1d(np.polyfit(data["x264"]["quality"], data["x264"]["avg_bpp"], 4))
+        results_x264["x264 bpp"] = results_x264.apply(lambda row: p(row["x264 crf"]), axis=1)
+        p = np.poly1d(np.polyfit(data["x264"]["quality"], data["x264"]["wavg_y_ssim_score"], 4))
+        results_x264["x264 y-ssim"] = results_x264.apply(lambda row: p(row["x264 crf"]), axis=1)
+        p = np.poly1d(np.polyfit(data["x264"]["quality"], data["x264"]["wavg_rgb_ssim_score"], 4))
+        results_x264["x264 rgb-ssim"] = results_x264.apply(lambda row: p(row["x264 crf"]), axis=1)
+        p = np.poly1d(np.polyfit(data["x264"]["quality"], data["x264"]["wavg_msssim_score"], 4))
+        results_x264["x264 ms-ssim"] = results_x264.apply(lambda row: p(row["x264 crf"]), axis=1)
+        p = np.poly1d(np.polyfit(data["x264"]["quality"], data["x264"]["wavg_psnrhvsm_score"], 4))
+        results_x264["x264 psnr-hvs-m"] = results_x264.apply(lambda row: p(row["x264 crf"]), axis=1)
+        p = np.poly1d(np.polyfit(data["x264"]["quality"], data["x264"]["wavg_vmaf_score"], 4))
+        results_x264["x264 vmaf"] = results_x264.apply(lambda row: p(row["x264 crf"]), axis=1)
 
+        if "crf_conversion.x264.1080" in stale:
             results_file = path + "/" + os.path.basename(path) + ".crf_conversion.x264.1080.lossy.out"
             results_x264.to_csv(results_file, sep=":")
             file = open(path + "/" + os.path.basename(path) + ".crf_conversion.x264.1080.lossy.md", "w")
@@ -286,58 +289,77 @@ def generate_plots(path, requested_formats):
             markdown_writer.write_table()
             file.write(markdown_writer.stream.getvalue())
             file.close()
+        
+        results = {}
+        for format in requested_formats:
+            if format + ".crf_conversion.1080" not in stale:
+                continue
+            results[format] = pd.DataFrame({"x264 crf": range(16, 25)})
+            p = np.poly1d(np.polyfit(data["x264"]["quality"], data["x264"]["avg_bpp"], 4))
+            results[format]["x264 bpp"] = results_x264.apply(lambda row: p(row["x264 crf"]), axis=1)
+            p = np.poly1d(np.polyfit(data[format]["wavg_y_ssim_score"], data[format]["quality"], 4))
+            results[format][format + " crf according to y-ssim"] = results_x264.apply(lambda row: p(row["x264 y-ssim"]), axis=1)
+            p = np.poly1d(np.polyfit(data[format]["quality"], data[format]["avg_bpp"], 4))
+            results[format][format + " bpp according to y-ssim"] = results[format].apply(lambda row: p(row[format + " crf according to y-ssim"]), axis=1)
+            results[format][format + " % reduction according to y-ssim"] = results[format].apply(lambda row: (row[format + " bpp according to y-ssim"] / row["x264 bpp"] -1) * 100, axis=1)
+            
+            p = np.poly1d(np.polyfit(data[format]["wavg_rgb_ssim_score"], data[format]["quality"], 4))
+            results[format][format + " crf according to rgb-ssim"] = results_x264.apply(lambda row: p(row["x264 rgb-ssim"]), axis=1)
+            p = np.poly1d(np.polyfit(data[format]["quality"], data[format]["avg_bpp"], 4))
+            results[format][format + " bpp according to rgb-ssim"] = results[format].apply(lambda row: p(row[format + " crf according to rgb-ssim"]), axis=1)
+            results[format][format + " % reduction according to rgb-ssim"] = results[format].apply(lambda row: (row[format + " bpp according to rgb-ssim"] / row["x264 bpp"] -1) * 100, axis=1)
+            
+            p = np.poly1d(np.polyfit(data[format]["wavg_msssim_score"], data[format]["quality"], 4))
+            results[format][format + " crf according to ms-ssim"] = results_x264.apply(lambda row: p(row["x264 ms-ssim"]), axis=1)
+            p = np.poly1d(np.polyfit(data[format]["quality"], data[format]["avg_bpp"], 4))
+            results[format][format + " bpp according to ms-ssim"] = results[format].apply(lambda row: p(row[format + " crf according to ms-ssim"]), axis=1)
+            results[format][format + " % reduction according to ms-ssim"] = results[format].apply(lambda row: (row[format + " bpp according to ms-ssim"] / row["x264 bpp"] -1) * 100, axis=1)
             
-            results = {}
-            for format in requested_formats:
-                results[format] = pd.DataFrame({"x264 crf": range(16, 25)})
-                p = np.poly1d(np.polyfit(data["x264"]["quality"], data["x264"]["avg_bpp"], 4))
-                results[format]["x264 bpp"] = results_x264.apply(lambda row: p(row["x264 crf"]), axis=1)
-                p = np.poly1d(np.polyfit(data[format]["wavg_y_ssim_score"], data[format]["quality"], 4))
-                results[format][format + " crf according to y-ssim"] = results_x264.apply(lambda row: p(row["x264 y-ssim"]), axis=1)
-                p = np.poly1d(np.polyfit(data[format]["quality"], data[format]["avg_bpp"], 4))
-                results[format][format + " bpp according to y-ssim"] = results[format].apply(lambda row: p(row[format + " crf according to y-ssim"]), axis=1)
-                results[format][format + " % reduction according to y-ssim"] = results[format].apply(lambda row: (row[format + " bpp according to y-ssim"] / row["x264 bpp"] -1) * 100, axis=1)
-                
-                p = np.poly1d(np.polyfit(data[format]["wavg_rgb_ssim_score"], data[format]["quality"], 4))
-                results[format][format + " crf according to rgb-ssim"] = results_x264.apply(lambda row: p(row["x264 rgb-ssim"]), axis=1)
-                p = np.poly1d(np.polyfit(data[format]["quality"], data[format]["avg_bpp"], 4))
-                results[format][format + " bpp according to rgb-ssim"] = results[format].apply(lambda row: p(row[format + " crf according to rgb-ssim"]), axis=1)
-                results[format][format + " % reduction according to rgb-ssim"] = results[format].apply(lambda row: (row[format + " bpp according to rgb-ssim"] / row["x264 bpp"] -1) * 100, axis=1)
-                
-                p = np.poly1d(np.polyfit(data[format]["wavg_msssim_score"], data[format]["quality"], 4))
-                results[format][format + " crf according to ms-ssim"] = results_x264.apply(lambda row: p(row["x264 ms-ssim"]), axis=1)
-                p = np.poly1d(np.polyfit(data[format]["quality"], data[format]["avg_bpp"], 4))
-                results[format][format + " bpp according to ms-ssim"] = results[format].apply(lambda row: p(row[format + " crf according to ms-ssim"]), axis=1)
-                results[format][format + " % reduction according to ms-ssim"] = results[format].apply(lambda row: (row[format + " bpp according to ms-ssim"] / row["x264 bpp"] -1) * 100, axis=1)
-                
-                p = np.poly1d(np.polyfit(data[format]["wavg_psnrhvsm_score"], data[format]["quality"], 4))
-                results[format][format + " crf according to psnr-hvs-m"] = results_x264.apply(lambda row: p(row["x264 psnr-hvs-m"]), axis=1)
-                p = np.poly1d(np.polyfit(data[format]["quality"], data[format]["avg_bpp"], 4))
-                results[format][format + " bpp according to psnr-hvs-m"] = results[format].apply(lambda row: p(row[format + " crf according to psnr-hvs-m"]), axis=1)
-                results[format][format + " % reduction according to psnr-hvs-m"] = results[format].apply(lambda row: (row[format + " bpp according to psnr-hvs-m"] / row["x264 bpp"] -1) * 100, axis=1)
-                
-                p = np.poly1d(np.polyfit(data[format]["wavg_vmaf_score"], data[format]["quality"], 4))
-                results[format][format + " crf according to vmaf"] = results_x264.apply(lambda row: p(row["x264 vmaf"]), axis=1)
-                p = np.poly1d(np.polyfit(data[format]["quality"], data[format]["avg_bpp"], 4))
-                results[format][format + " bpp according to vmaf"] = results[format].apply(lambda row: p(row[format + " crf according to vmaf"]), axis=1)
-                results[format][format + " % reduction according to vmaf"] = results[format].apply(lambda row: (row[format + " bpp according to vmaf"] / row["x264 bpp"] -1) * 100, axis=1)
-
-                results_file = path + "/" + os.path.basename(path) + "." + format + ".crf_conversion.1080.lossy.out"
-                results[format].to_csv(results_file, sep=":")
-                file = open(path + "/" + os.path.basename(path) + "." + format + ".crf_conversion.1080.lossy.md", "w")
-                markdown_writer = pytablewriter.MarkdownTableWriter()
-                markdown_writer.from_dataframe(results[format])
-                markdown_writer.stream = six.StringIO()
-                markdown_writer.write_table()
-                file.write(markdown_writer.stream.getvalue())
-                file.close()
+            p = np.poly1d(np.polyfit(data[format]["wavg_psnrhvsm_score"], data[format]["quality"], 4))
+            results[format][format + " crf according to psnr-hvs-m"] = results_x264.apply(lambda row: p(row["x264 psnr-hvs-m"]), axis=1)
+            p = np.poly1d(np.polyfit(data[format]["quality"], data[format]["avg_bpp"], 4))
+            results[format][format + " bpp according to psnr-hvs-m"] = results[format].apply(lambda row: p(row[format + " crf according to psnr-hvs-m"]), axis=1)
+            results[format][format + " % reduction according to psnr-hvs-m"] = results[format].apply(lambda row: (row[format + " bpp according to psnr-hvs-m"] / row["x264 bpp"] -1) * 100, axis=1)
+            
+            p = np.poly1d(np.polyfit(data[format]["wavg_vmaf_score"], data[format]["quality"], 4))
+            results[format][format + " crf according to vmaf"] = results_x264.apply(lambda row: p(row["x264 vmaf"]), axis=1)
+            p = np.poly1d(np.polyfit(data[format]["quality"], data[format]["avg_bpp"], 4))
+            results[format][format + " bpp according to vmaf"] = results[format].apply(lambda row: p(row[format + " crf according to vmaf"]), axis=1)
+            results[format][format + " % reduction according to vmaf"] = results[format].apply(lambda row: (row[format + " bpp according to vmaf"] / row["x264 bpp"] -1) * 100, axis=1)
+
+            results_file = path + "/" + os.path.basename(path) + "." + format + ".crf_conversion.1080.lossy.out"
+            results[format].to_csv(results_file, sep=":")
+            file = open(path + "/" + os.path.basename(path) + "." + format + ".crf_conversion.1080.lossy.md", "w")
+            markdown_writer = pytablewriter.MarkdownTableWriter()
+            markdown_writer.from_dataframe(results[format])
+            markdown_writer.stream = six.StringIO()
+            markdown_writer.write_table()
+            file.write(markdown_writer.stream.getvalue())
+            file.close()
+
+        manifest.update(stale)
+        # Key of the tables before they were hashed one by one
+        manifest.pop("crf_conversion.1080", None)
+        write_manifest(path, manifest)
 
 
 def main(argv):
     if sys.version_info[0] < 3 and sys.version_info[1] < 5:
         raise Exception("Python 3.5 or a more recent version is required.")
 
-    if len(argv) < 2 or len(argv) > 3:
+    image_format = "svg"
+    force = False
+    try:
+        opts, args = getopt.getopt(argv[1:], "", ["image=", "force"])
+        for opt, value in opts:
+            if opt == "--image":
+                image_format = value
+            elif opt == "--force":
+                force = True
+    except getopt.GetoptError:
+        args = []
+
+    if len(args) < 1 or len(args) > 2 or image_format not in image_formats:
         print(
             "Arg 1: Path to a subset with results generated by rd_average.py")
         print("       For ex: rd_average.py \"results/subset1\"")
@@ -345,8 +367,13 @@ def main(argv):
         print(
             "       For ex: rd_average.py \"results/subset1\" \"av1,vp9,x264,x265\""
         )
+        print("Options:")
+        print("  --image: file format of the figures, among {} (svg by default)".
+              format(image_formats))
+        print("  --force: draw every figure, even if its averages did not change")
+        return
 
-    results_folder = os.path.normpath(argv[1])
+    results_folder = os.path.normpath(args[0])
 
     if (not os.path.isdir(results_folder)
             or not glob.glob(results_folder + "/*.lossy.out")):
@@ -361,7 +388,7 @@ def main(argv):
         available_formats.append(os.path.basename(f).split(".")[1])
 
     try:
-        requested_formats = [format.strip() for format in argv[2].split(",")]
+        requested_formats = [format.strip() for format in args[1].split(",")]
     except IndexError:
         requested_formats = available_formats
 
@@ -371,7 +398,7 @@ def main(argv):
                   format(format, available_formats))
             return
 
-    generate_plots(results_folder, requested_formats)
+    generate_plots(results_folder, requested_formats, image_format, force)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,303 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+# Typed, columnar store of the per-clip results of a subset, kept in a
+# SQLite database next to the colon-separated .out files:
+#
+#   results/<subset>/results.sqlite
+#
+# rd_collect.py adds the results of each clip once complete, and
+# rd_average.py and rd_plot.py only read the columns and rows they need. The
+# .out files can be exported from the store, and imported into it.
+
+import os
+import sys
+import glob
+import time
+import sqlite3
+import numpy as np
+import pandas as pd
+
+# Columns of the results files
+result_columns = [
+    "file_name", "quality", "orig_file_size", "compressed_file_size",
+    "height", "frames", "pixels", "bpp", "compression_ratio", "encode_time",
+    "encode_fpm", "decode_time", "decode_fpm", "y_ssim_score",
+    "rgb_ssim_score", "msssim_score", "psnrhvsm_score", "vmaf_score",
+    "encode_user_time", "encode_sys_time", "encode_maxrss",
+    "encode_time_spread", "decode_user_time", "decode_sys_time",
+    "decode_maxrss", "decode_time_spread"
+]
+
+# Columns written as integers, the others being floats
+integer_columns = [
+    "orig_file_size", "compressed_file_size", "height", "frames", "pixels",
+    "encode_maxrss", "decode_maxrss"
+]
+
+store_name = "results.sqlite"
+
+# Metrics of the per-frame scores, in the order of the rows of their arrays
+frame_metrics = ["y_ssim", "rgb_ssim", "msssim", "psnrhvsm", "vmaf"]
+
+
+def get_store_file(results_folder):
+    return os.path.join(results_folder, store_name)
+
+
+def column_type(column):
+    if column == "file_name":
+        return "TEXT"
+    elif column in integer_columns:
+        return "INTEGER"
+    return "REAL"
+
+
+# Every row also has the format, and the index of the line in the results
+# file of its clip. The version of the results of each clip, the time they
+# were inserted, lets rd_average.py find the clips that changed.
+def connect(path):
+    connection = sqlite3.connect(path, timeout=60)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS lossy (format TEXT NOT NULL, "
+        "point INTEGER NOT NULL, " +
+        ", ".join(column + " " + column_type(column)
+                  for column in result_columns) +
+        ", PRIMARY KEY (format, file_name, point))")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS lossy_height ON lossy (format, height)")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS clips (format TEXT NOT NULL, "
+        "file_name TEXT NOT NULL, version INTEGER NOT NULL, "
+        "PRIMARY KEY (format, file_name))")
+    return connection
+
+
+# Replaces the results of a clip by the given rows, dicts of result_columns
+def insert_results(path, format, file_name, rows):
+    connection = connect(path)
+    with connection:
+        connection.execute("DELETE FROM lossy WHERE format = ? AND file_name = ?",
+                           (format, file_name))
+        connection.executemany(
+            "INSERT INTO lossy (format, point, " + ", ".join(result_columns) +
+            ") VALUES (" + ", ".join(["?"] * (len(result_columns) + 2)) + ")",
+            [[format, point] + [row.get(column) for column in result_columns]
+             for (point, row) in enumerate(rows)])
+        connection.execute(
+            "INSERT OR REPLACE INTO clips (format, file_name, version) "
+            "VALUES (?, ?, ?)", (format, file_name, time.time_ns()))
+    connection.close()
+
+
+def has_results(path, format):
+    if not os.path.isfile(path):
+        return False
+    connection = connect(path)
+    found = connection.execute("SELECT 1 FROM lossy WHERE format = ? LIMIT 1",
+                               (format, )).fetchone() is not None
+    connection.close()
+    return found
+
+
+def get_formats(path):
+    connection = connect(path)
+    formats = [
+        row[0]
+        for row in connection.execute("SELECT DISTINCT format FROM lossy")
+    ]
+    connection.close()
+    return formats
+
+
+def get_resolutions(path, format):
+    connection = connect(path)
+    resolutions = [
+        row[0] for row in connection.execute(
+            "SELECT DISTINCT height FROM lossy WHERE format = ? ORDER BY height",
+            (format, ))
+    ]
+    connection.close()
+    return resolutions
+
+
+# Returns the version of the results of each clip of a format, 0 for the
+# clips inserted before versions were recorded
+def get_clip_versions(path, format):
+    connection = connect(path)
+    versions = {
+        file_name: version
+        for (file_name, version) in connection.execute(
+            "SELECT DISTINCT lossy.file_name, COALESCE(clips.version, 0) "
+            "FROM lossy LEFT JOIN clips ON clips.format = lossy.format "
+            "AND clips.file_name = lossy.file_name WHERE lossy.format = ?",
+            (format, ))
+    }
+    connection.close()
+    return versions
+
+
+# Returns the results of a format as a DataFrame, ordered by clip and point.
+# columns restricts the columns read (file_name and point are always
+# included), height and file_names the rows.
+def read_results(path, format, columns=None, height=None, file_names=None):
+    if columns is None:
+        columns = result_columns
+    columns = ["file_name", "point"] + [
+        column for column in columns if column not in ("file_name", "point")
+    ]
+    query = "SELECT " + ", ".join(columns) + " FROM lossy WHERE format = ?"
+    params = [format]
+    if height is not None:
+        query += " AND height = ?"
+        params.append(height)
+
+    connection = connect(path)
+    if file_names is None:
+        data = pd.read_sql_query(query + " ORDER BY file_name, point",
+                                 connection, params=params)
+    else:
+        # A query per chunk of clips, to stay below the limit on the number
+        # of parameters
+        file_names = sorted(file_names)
+        chunks = []
+        for i in range(0, max(len(file_names), 1), 500):
+            chunk = file_names[i:i + 500]
+            chunks.append(
+                pd.read_sql_query(
+                    query + " AND file_name IN (" +
+                    ", ".join(["?"] * len(chunk)) +
+                    ") ORDER BY file_name, point",
+                    connection,
+                    params=params + chunk))
+        data = pd.concat(chunks, ignore_index=True)
+    connection.close()
+    # The columns that are NULL in every row, like the CPU times of results
+    # imported from older .out files, are read as objects
+    for column in columns[1:]:
+        if data[column].dtype == object:
+            data[column] = data[column].astype(np.float64)
+    return data
+
+
+# The per-frame scores of a point are kept, when captured, as a float32 array
+# of one row per metric of frame_metrics, in a .npy file that can be mapped:
+#
+#   results/<subset>/<format>/frames/<clip>.<format>.<quality>.npy
+def get_frames_file(results_folder, format, file_name, quality):
+    return os.path.join(results_folder, format, "frames",
+                        "%s.%s.%f.npy" % (file_name, format, quality))
+
+
+def write_frames(path, frames):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = path + ".tmp.npy"
+    np.save(tmp_file, np.asarray(frames, dtype=np.float32))
+    os.replace(tmp_file, path)
+
+
+def read_frames(path):
+    return np.load(path, mmap_mode="r")
+
+
+# Writes the legacy .out files of every clip of the store
+def export_results(results_folder):
+    path = get_store_file(results_folder)
+    for format in get_formats(path):
+        data = read_results(path, format)
+        for file_name, clip in data.groupby("file_name", sort=False):
+            result_file = os.path.join(results_folder, format, "lossy",
+                                       file_name + "." + format + ".out")
+            os.makedirs(os.path.dirname(result_file), exist_ok=True)
+            clip = clip.sort_values("point")[result_columns]
+            clip.to_csv(result_file, sep=":", index=False, float_format="%f")
+            print("Exported {}.".format(result_file))
+
+
+def import_file(path, format, result_file):
+    try:
+        data = pd.read_csv(result_file, sep=":", dtype={"file_name": str})
+    except pd.errors.EmptyDataError:
+        return
+    rows = data.to_dict("records")
+    if not rows:
+        return
+    insert_results(path, format, str(rows[0]["file_name"]), rows)
+    print("Imported {}.".format(result_file))
+
+
+# Adds the existing .out files to the store
+def import_results(results_folder):
+    path = get_store_file(results_folder)
+    for result_file in sorted(
+            glob.glob(os.path.join(results_folder, "*", "lossy", "*.out"))):
+        format = os.path.basename(os.path.dirname(os.path.dirname(result_file)))
+        import_file(path, format, result_file)
+
+
+# Adds the .out files of a format that the store lacks, or that were written
+# after their results were inserted in it, like the results of the clips
+# collected before the store existed. rd_collect.py does not process these
+# clips again, and they would otherwise be left out of the store.
+def import_missing(results_folder, format):
+    path = get_store_file(results_folder)
+    versions = get_clip_versions(path, format)
+    for result_file in sorted(
+            glob.glob(
+                os.path.join(results_folder, format, "lossy",
+                             "*." + format + ".out"))):
+        file_name = os.path.basename(result_file)[:-len("." + format + ".out")]
+        if os.stat(result_file).st_mtime_ns > versions.get(file_name, -1):
+            import_file(path, format, result_file)
+
+
+def main(argv):
+    if len(argv) != 3 or argv[1] not in ("export", "import"):
+        print(
+            "results_store.py: Convert between the results store of a subset and its .out files"
+        )
+        print("Arg 1: 'export' to write the .out files from the store, "
+              "'import' to add the .out files to the store")
+        print("Arg 2: Path to the results of a subset generated by rd_collect.py")
+        print("       For ex: results_store.py export \"results/subset1\"")
+        return
+
+    results_folder = os.path.normpath(argv[2])
+    if argv[1] == "export":
+        if not os.path.isfile(get_store_file(results_folder)):
+            print("Could not find the results store {}.".format(
+                get_store_file(results_folder)))
+            return
+        export_results(results_folder)
+    else:
+        import_results(results_folder)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
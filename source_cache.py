@@ -0,0 +1,140 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+# Content-addressed cache for the prepared versions of the sources (10-bit
+# Y4M, raw YUV, ...). An entry is keyed by the source path, size and mtime
+# plus the conversion parameters, so it is built once per clip and reused by
+# every quality step and every format. The cache is kept under a disk budget,
+# least recently used entries being evicted first.
+#
+# Every entry has a lock file next to it: the entry is built under an
+# exclusive lock and used under a shared one, so that an entry can never be
+# evicted while another process is still reading it.
+
+import os
+import errno
+import fcntl
+import glob
+import hashlib
+import json
+from contextlib import contextmanager
+
+
+def create_cache_dir(cache_dir):
+    try:
+        os.makedirs(cache_dir)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def cache_key(source, params):
+    st = os.stat(source)
+    description = json.dumps(
+        [os.path.abspath(source), st.st_size, st.st_mtime_ns, params])
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+
+def entry_size(entry):
+    try:
+        return os.path.getsize(entry)
+    except FileNotFoundError:
+        return 0
+
+
+def list_entries(cache_dir):
+    return [
+        f for f in glob.glob(os.path.join(cache_dir, "*"))
+        if not f.endswith(".lock") and ".partial." not in f
+    ]
+
+
+def evict(cache_dir, budget, keep=()):
+    # Oldest entries first; the mtime of an entry is refreshed on each hit.
+    entries = []
+    for entry in list_entries(cache_dir):
+        try:
+            st = os.stat(entry)
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, entry))
+    entries.sort()
+
+    total = sum(size for (_, size, _) in entries)
+    for (_, size, entry) in entries:
+        if total <= budget:
+            break
+        if entry in keep:
+            continue
+        # Lock files are never removed, so that every process always agrees
+        # on the lock protecting an entry.
+        with open(entry + ".lock", "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Pinned by a running job
+                continue
+            try:
+                os.remove(entry)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+
+@contextmanager
+def prepared(cache_dir, budget, source, suffix, params, build):
+    """Yield the path of the cached preparation of source.
+
+    build(path) is only called on a miss and must create path, which ends
+    with suffix. The entry is pinned for the duration of the with block.
+    """
+    create_cache_dir(cache_dir)
+    key = cache_key(source, params)
+    entry = os.path.join(cache_dir, key + suffix)
+
+    with open(entry + ".lock", "a") as lock:
+        while True:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            if os.path.isfile(entry):
+                break
+            # Miss: upgrade to an exclusive lock and check again, another
+            # process may have built the entry in the meantime.
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.isfile(entry):
+                partial = os.path.join(cache_dir, key + ".partial" + suffix)
+                try:
+                    build(partial)
+                    os.replace(partial, entry)
+                finally:
+                    if os.path.isfile(partial):
+                        os.remove(partial)
+
+        os.utime(entry)
+        evict(cache_dir, budget, keep=(entry, ))
+        yield entry
@@ -0,0 +1,210 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+# Staging area for the intermediate files of the jobs: the decoded videos and
+# their conversions to Y4M and raw YUV. The area is made of tiers, fastest
+# first (e.g. a tmpfs, then a disk), each with a budget in bytes. A job
+# reserves the size of its intermediates up front, in the first tier with
+# enough room left, and waits when no tier has. This bounds the amount of
+# uncompressed video staged at once, whatever the number of parallel jobs.
+#
+# A reservation is a private directory in the tier, named after the process
+# owning it and the reserved size:
+#
+#   <tier>/<pid>-<n>.<size>
+#
+# The directory is removed with everything inside it when the job is done or
+# fails. The reservations of the processes that died without removing them
+# are removed by the next reservation in the tier. A tier is only shared by
+# the processes of one machine, and every tier has a lock file so that they
+# agree on the reservations.
+
+import os
+import re
+import sys
+import errno
+import fcntl
+import shutil
+import itertools
+import time
+import tracing
+from contextlib import contextmanager
+
+reservation_pattern = re.compile(r"(\d+)-\d+\.(\d+)$")
+
+# Seconds between two attempts to reserve space when every tier is full
+poll_interval = 1
+
+reservations = itertools.count()
+
+
+def create_tier_dir(tier_dir):
+    try:
+        os.makedirs(tier_dir)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Returns the live reservations of a tier as (path, size) tuples, and
+# removes the ones left by dead processes
+def list_reservations(tier_dir):
+    found = []
+    for name in os.listdir(tier_dir):
+        match = reservation_pattern.match(name)
+        if match is None:
+            continue
+        path = os.path.join(tier_dir, name)
+        if not is_alive(int(match.group(1))):
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        found.append((path, int(match.group(2))))
+    return found
+
+
+# The budget of a tier is capped by the size of its filesystem, since a
+# tmpfs is usually smaller than the budget configured for it. The space
+# actually free is checked when reserving, see tier_room().
+def tier_budget(tier_dir, budget):
+    st = os.statvfs(tier_dir)
+    return min(budget, st.f_blocks * st.f_frsize)
+
+
+# Bytes written so far in the given reservations
+def get_written_size(paths):
+    total = 0
+    for path in paths:
+        for (root, dirs, files) in os.walk(path):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_size
+                except FileNotFoundError:
+                    pass
+    return total
+
+
+# Bytes of the given reservations still to be written
+def get_pending_size(reserved):
+    return max(
+        sum(size for (path, size) in reserved) -
+        get_written_size([path for (path, size) in reserved]), 0)
+
+
+# Returns the room left in a tier with the given live reservations: its
+# budget minus the reservations, capped by the free space of its filesystem,
+# which may be shared with other users or with the cache of prepared sources.
+# The free space already lacks what the reservations wrote so far, so only
+# the part of them still to be written is taken off it, along with that of
+# the other tiers on the same filesystem.
+def tier_room(tier_dir, budget, reserved, tier_dirs):
+    st = os.statvfs(tier_dir)
+    pending = get_pending_size(reserved)
+    device = os.stat(tier_dir).st_dev
+    for other_dir in tier_dirs:
+        if other_dir != tier_dir and os.stat(other_dir).st_dev == device:
+            pending += get_pending_size(list_reservations(other_dir))
+    return min(budget - sum(size for (path, size) in reserved),
+               st.f_bavail * st.f_frsize - pending)
+
+
+# Reserves size bytes in the first tier with enough room, and returns the
+# directory of the reservation, or None if every tier is full. A size larger
+# than every budget is given the last tier once it is empty, so that it runs
+# alone instead of waiting forever.
+def try_reserve(tiers, size):
+    available = []
+    for (tier_dir, budget) in tiers:
+        try:
+            create_tier_dir(tier_dir)
+        except OSError:
+            # Missing tmpfs
+            continue
+        available.append((tier_dir, tier_budget(tier_dir, budget)))
+    if not available:
+        raise OSError("None of the staging tiers can be used: {}".format(
+            ", ".join(tier_dir for (tier_dir, budget) in tiers)))
+    oversized = all(size > budget for (tier_dir, budget) in available)
+
+    for (i, (tier_dir, budget)) in enumerate(available):
+        with open(os.path.join(tier_dir, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            reserved = list_reservations(tier_dir)
+            if size <= tier_room(
+                    tier_dir, budget, reserved,
+                    [other_dir for (other_dir, other) in available]) or (
+                    oversized and not reserved and i == len(available) - 1):
+                path = os.path.join(
+                    tier_dir,
+                    "%d-%d.%d" % (os.getpid(), next(reservations), size))
+                os.mkdir(path)
+                return path
+    return None
+
+
+@contextmanager
+def staged(tiers, size):
+    """Yield a private directory for size bytes of intermediate files.
+
+    tiers is a list of (directory, budget in bytes), fastest first. Blocks
+    until one of them has room for size bytes. The directory and its content
+    are removed on exit, even when the with block fails.
+    """
+    with tracing.span("staging", bytes=size):
+        path = try_reserve(tiers, size)
+        if path is None:
+            sys.stderr.write(
+                "Waiting for {} bytes of staging space.\n".format(size))
+            while path is None:
+                time.sleep(poll_interval)
+                path = try_reserve(tiers, size)
+    try:
+        yield path
+    finally:
+        with tracing.span("cleanup"):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+# Removes the reservations of the processes that died, e.g. the workers of a
+# terminated pool
+def remove_stale(tiers):
+    for (tier_dir, budget) in tiers:
+        if os.path.isdir(tier_dir):
+            with open(os.path.join(tier_dir, ".lock"), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                list_reservations(tier_dir)
@@ -0,0 +1,135 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+# Fan-out of a decoded Y4M stream to the metric tools through named pipes, so
+# that the decoded video never hits the disk. The decoder writes to a fifo,
+# and tee() copies every frame to one fifo (or regular file) per tool, either
+# as Y4M or as raw YUV with the Y4M framing stripped.
+
+import os
+import errno
+import fcntl
+import time
+import y4m
+
+
+def make_fifo(path):
+    os.mkfifo(path)
+
+
+# Opening a fifo for writing blocks until a reader opens it, which never
+# happens if the tool failed early, so poll until it is abandoned.
+def open_writer(path, abandoned):
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as exc:
+            if exc.errno != errno.ENXIO:
+                raise
+            if abandoned.is_set():
+                return None
+            time.sleep(0.01)
+            continue
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        return fd
+
+
+# Wakes up a reader still waiting for a writer to open the fifo, so that it
+# reads EOF instead of blocking forever.
+def release_reader(path):
+    try:
+        os.close(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+    except OSError as exc:
+        if exc.errno not in (errno.ENXIO, errno.ENOENT):
+            raise
+
+
+# Reads the fifo until EOF and throws the data away, e.g. to time a decoder
+# without writing its output anywhere
+def drain(path):
+    with open(path, "rb", buffering=0) as f:
+        while f.read(1 << 20):
+            pass
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+# Copies the Y4M stream of the source fifo to every output. outputs is a list
+# of (path, raw, abandoned): a raw output only gets the frame payloads, like
+# a .yuv file. A regular file is written as is, a fifo is given up when its
+# reader is gone or the abandoned event is set.
+def tee(source, outputs):
+    fds = [None] * len(outputs)
+    try:
+        with open(source, "rb") as src:
+            for i, (path, raw, abandoned) in enumerate(outputs):
+                if os.path.exists(path) and not os.path.isfile(path):
+                    fds[i] = open_writer(path, abandoned)
+                else:
+                    fds[i] = os.open(path,
+                                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+
+            header_line = src.readline()
+            size = y4m.frame_size(y4m.parse_header(header_line))
+            chunks = [header_line]
+            while True:
+                frame_line = src.readline()
+                if not frame_line:
+                    break
+                if not frame_line.startswith(y4m.frame_signature):
+                    raise ValueError("Corrupted YUV4MPEG2 stream")
+                payload = src.read(size)
+                if len(payload) != size:
+                    raise ValueError("Truncated YUV4MPEG2 stream")
+                chunks += [frame_line, payload]
+
+                for i, (path, raw, abandoned) in enumerate(outputs):
+                    if fds[i] is None:
+                        continue
+                    try:
+                        for chunk in chunks:
+                            if raw and chunk is not payload:
+                                continue
+                            write_all(fds[i], chunk)
+                    except BrokenPipeError:
+                        os.close(fds[i])
+                        fds[i] = None
+                chunks = []
+    finally:
+        for fd in fds:
+            if fd is not None:
+                os.close(fd)
+        for (path, raw, abandoned) in outputs:
+            if not os.path.isfile(path):
+                release_reader(path)
@@ -0,0 +1,110 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+# Parity of the native metrics with known scores, on a fixed pair of 10 bits
+# Y4M clips. The known Y-SSIM of each frame is the one of scikit-image's
+# structural_similarity (Gaussian window of sigma 1.5, no sample covariance),
+# which agrees to 1e-6. The scores were not compared with those of
+# dump_ssim and dump_msssim, which are not available here (see README.md).
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metrics
+
+known_y_ssim = [0.9752078, 0.9750616]
+known_msssim = [0.9973105, 0.9972616]
+
+
+def write_y4m(path, planes):
+    (frames, height, width) = planes.shape
+    chroma = np.full(2 * ((width + 1) // 2) * ((height + 1) // 2), 512,
+                     dtype="<u2").tobytes()
+    with open(path, "wb") as f:
+        f.write(b"YUV4MPEG2 W%d H%d F25:1 Ip A1:1 C420p10\n" % (width, height))
+        for plane in planes:
+            f.write(b"FRAME\n")
+            f.write(plane.astype("<u2").tobytes())
+            f.write(chroma)
+
+
+# A textured reference and its copy with Gaussian noise, large enough for
+# the five scales of MS-SSIM
+@pytest.fixture
+def clip_pair(tmp_path, width=192, height=176, frames=2):
+    rng = np.random.default_rng(2018)
+    (y, x) = np.mgrid[0:height, 0:width]
+    base = 512 + 300 * np.sin(x / 9.0) * np.cos(y / 13.0)
+    ref = np.clip(base + rng.normal(0, 40, (frames, height, width)), 0, 1023)
+    dist = np.clip(ref + rng.normal(0, 12, ref.shape), 0, 1023)
+    paths = (str(tmp_path / "ref.y4m"), str(tmp_path / "dist.y4m"))
+    write_y4m(paths[0], ref.round())
+    write_y4m(paths[1], dist.round())
+    return paths
+
+
+def test_y_ssim(clip_pair):
+    frames = metrics.y_ssim_frames(*clip_pair)
+    np.testing.assert_allclose(frames, known_y_ssim, atol=1e-6)
+    assert metrics.to_db(np.mean(frames)) == pytest.approx(16.0441, abs=1e-3)
+
+
+def test_msssim(clip_pair):
+    frames = metrics.msssim_frames(*clip_pair)
+    np.testing.assert_allclose(frames, known_msssim, atol=1e-6)
+    assert metrics.to_db(np.mean(frames)) == pytest.approx(25.6640, abs=1e-3)
+
+
+def test_reference_stats(clip_pair, tmp_path):
+    path = str(tmp_path / "ref.ssim5.npy")
+    metrics.write_reference_stats(clip_pair[0], 5, path)
+    stats = metrics.read_reference_stats(clip_pair[0], 5, path)
+    np.testing.assert_allclose(
+        metrics.msssim_frames(*clip_pair, stats), known_msssim, atol=1e-6)
+    np.testing.assert_allclose(
+        metrics.y_ssim_frames(*clip_pair, stats[:1]), known_y_ssim, atol=1e-6)
+
+
+def test_identical(clip_pair):
+    frames = metrics.msssim_frames(clip_pair[0], clip_pair[0])
+    np.testing.assert_allclose(frames, 1, atol=1e-6)
+    assert metrics.to_db(1.0) == float("inf")
+
+
+# QCIF is too small for the window at the fifth scale of MS-SSIM, which is
+# reported before any statistics are computed
+def test_too_small():
+    qcif = {'width': 176, 'height': 144, 'frames': 1}
+    assert metrics.fits(qcif, 1)
+    assert not metrics.fits(qcif, len(metrics.msssim_weights))
+    with pytest.raises(ValueError):
+        metrics.stats_shapes(qcif, len(metrics.msssim_weights))
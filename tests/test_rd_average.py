@@ -0,0 +1,97 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+# Parity of rd_average.py with the averages of the original implementation.
+# tests/golden/subset holds the results files of five clips at three
+# resolutions, and tests/golden/expected the averages the original
+# rd_average.py computed from them. The columns it computed must be equal.
+
+import os
+import sys
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import rd_average
+import results_store
+
+golden = os.path.join(root, "tests", "golden")
+
+
+@pytest.fixture
+def subset(tmp_path):
+    path = str(tmp_path / "subset")
+    shutil.copytree(os.path.join(golden, "subset"), path)
+    return path
+
+
+def check_averages(path, rtol=0):
+    for expected_file in sorted(os.listdir(os.path.join(golden, "expected"))):
+        expected = pd.read_csv(
+            os.path.join(golden, "expected", expected_file), sep=":")
+        averages = pd.read_csv(os.path.join(path, expected_file), sep=":")
+        assert np.allclose(averages[expected.columns].values, expected.values,
+                           rtol=rtol, atol=0, equal_nan=True), expected_file
+
+
+def test_golden_averages(subset):
+    rd_average.get_lossy_average((subset, "x264"))
+    check_averages(subset)
+
+
+# Averages from the sums of the manifest, the clips being added in two runs;
+# the sums then differ from a single run in the order of the additions only
+def test_golden_added_clips(subset, tmp_path):
+    lossy = os.path.join(subset, "x264", "lossy")
+    later = str(tmp_path / "later")
+    os.makedirs(later)
+    for name in ("clip_d.x264.out", "clip_e.x264.out"):
+        shutil.move(os.path.join(lossy, name), later)
+    rd_average.update_lossy_average((subset, "x264"))
+    for name in os.listdir(later):
+        shutil.move(os.path.join(later, name), lossy)
+    rd_average.update_lossy_average((subset, "x264"))
+    check_averages(subset, rtol=1e-12)
+
+
+# Per-frame scores kept after the averages were computed are averaged too
+def test_added_frames(subset):
+    rd_average.update_lossy_average((subset, "x264"))
+    data = rd_average.load_results(subset, "x264", "files")
+    for (file_name, quality) in zip(data["file_name"], data["quality"]):
+        results_store.write_frames(
+            results_store.get_frames_file(subset, "x264", file_name, quality),
+            np.full((len(results_store.frame_metrics), 4), 0.5))
+    rd_average.update_lossy_average((subset, "x264"))
+    averages = pd.read_csv(
+        rd_average.get_average_file(subset, "x264", "any"), sep=":")
+    assert np.allclose(averages["wavg_p5_y_ssim_score"], 0.5)
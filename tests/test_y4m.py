@@ -0,0 +1,65 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import y4m
+
+
+def parse(tags):
+    return y4m.parse_header(b"YUV4MPEG2 W4 H2 F25:1 " + tags + b"\n")
+
+
+def test_frame_size():
+    assert y4m.frame_size(parse(b"C420p10")) == 24
+    assert y4m.frame_size(parse(b"C420jpeg")) == 12
+    assert y4m.frame_size(parse(b"C444p12")) == 48
+    assert y4m.frame_size(parse(b"Cmono16")) == 16
+    # Alpha is a fourth full plane
+    assert y4m.frame_size(parse(b"C444alpha")) == 32
+
+
+def test_unsupported_chroma():
+    for tags in (b"C411", b"Cfoo"):
+        with pytest.raises(ValueError):
+            parse(tags)
+
+
+def test_probe_444alpha(tmp_path):
+    path = str(tmp_path / "alpha.y4m")
+    with open(path, "wb") as f:
+        f.write(b"YUV4MPEG2 W4 H2 F25:1 C444alpha\n")
+        for i in range(3):
+            f.write(b"FRAME\n" + bytes([i]) * 32)
+    header = y4m.probe(path)
+    assert header['frames'] == 3
+    assert header['frame_header_size'] == len(b"FRAME\n")
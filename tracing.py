@@ -0,0 +1,172 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+# Timed spans of the stages of a run, written as Chrome trace events that
+# chrome://tracing and Perfetto can load. Every process appends its events to
+# the trace file as they end, one JSON line per event and a single write per
+# line, so a trace stays readable even when the run is interrupted:
+#
+#   [
+#   {"name": "encode", "ph": "X", "ts": ..., "dur": ..., "pid": ..., ...},
+#   ...
+#
+# finish() then rewrites it as a complete JSON object. A span costs a clock
+# read and a write, and nothing when tracing is disabled.
+
+import os
+import sys
+import json
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Path and file descriptor of the trace of the process, None when disabled
+trace_path = None
+trace_fd = None
+
+# Arguments added to every span of the process, e.g. the point it processes
+tags = {}
+
+
+# Creates an empty trace, and enables tracing in the process
+def create(path):
+    with open(path, "w") as f:
+        f.write("[\n")
+    enable(path)
+
+
+# Enables tracing to an existing trace, e.g. in the workers of a pool
+def enable(path):
+    global trace_path, trace_fd
+    if trace_path == path and trace_fd is not None:
+        return
+    trace_path = path
+    trace_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+
+def is_enabled():
+    return trace_fd is not None
+
+
+def write_event(event):
+    os.write(trace_fd, (json.dumps(event) + ",\n").encode("utf-8"))
+
+
+@contextmanager
+def tagged(**args):
+    """Add args to the spans of the process for the duration of the block."""
+    previous = dict(tags)
+    tags.update(args)
+    try:
+        yield
+    finally:
+        tags.clear()
+        tags.update(previous)
+
+
+@contextmanager
+def span(name, **args):
+    """Time the block as a span named name, tagged with args.
+
+    Yields the dict of the arguments of the span, to which the block can add
+    values known once it ran, e.g. the bytes it processed.
+    """
+    if trace_fd is None:
+        yield {}
+        return
+    args = dict(tags, **args)
+    start = time.time_ns()
+    begin = time.perf_counter_ns()
+    try:
+        yield args
+    finally:
+        duration = time.perf_counter_ns() - begin
+        write_event({
+            'name': name,
+            'cat': "rd_collect",
+            'ph': "X",
+            'ts': start / 1000,
+            'dur': duration / 1000,
+            'pid': os.getpid(),
+            'tid': threading.get_native_id(),
+            'args': args
+        })
+
+
+def read_events(path):
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip().rstrip(",")
+            if not line or line == "[":
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # Torn last line of an interrupted process
+                continue
+    return events
+
+
+def disable():
+    global trace_path, trace_fd
+    if trace_fd is not None:
+        os.close(trace_fd)
+    trace_path = None
+    trace_fd = None
+
+
+# Rewrites the trace of the run as a complete JSON object, disables tracing,
+# and returns its events
+def finish():
+    path = trace_path
+    disable()
+    events = read_events(path)
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': "ms"}, f)
+    os.replace(tmp_file, path)
+    return events
+
+
+# Prints the stages taking the most time in total, over every process
+def print_summary(events, top=10, file=sys.stdout):
+    totals = defaultdict(float)
+    counts = defaultdict(int)
+    for event in events:
+        totals[event['name']] += event['dur']
+        counts[event['name']] += 1
+    file.write("{:<24} {:>8} {:>12} {:>12}\n".format("Stage", "Count",
+                                                      "Total (s)",
+                                                      "Mean (ms)"))
+    for name in sorted(totals, key=totals.get, reverse=True)[:top]:
+        file.write("{:<24} {:>8} {:>12.3f} {:>12.3f}\n".format(
+            name, counts[name], totals[name] / 1e6,
+            totals[name] / counts[name] / 1e3))
@@ -0,0 +1,237 @@
+# Copyright 2017-2018 Wyoh Knott
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+# Helpers for the YUV4MPEG2 format, as written by ffmpeg and the decoders:
+#
+#   YUV4MPEG2 W1920 H1080 F30000:1001 Ip A1:1 C420p10 XYSCSS=420P10\n
+#   FRAME\n<frame payload>FRAME\n<frame payload>...
+
+import os
+import re
+import numpy as np
+
+signature = b"YUV4MPEG2"
+frame_signature = b"FRAME"
+
+# Chroma subsamplings with a known frame layout, the other ones, like 411,
+# being rejected
+chroma_formats = ["mono", "420", "422", "444", "444alpha"]
+
+
+def parse_header(line):
+    if not line.startswith(signature) or not line.endswith(b"\n"):
+        raise ValueError("Not a YUV4MPEG2 stream")
+
+    header = {'chroma': "420", 'bit_depth': 8, 'frame_rate': None}
+    for token in line.split()[1:]:
+        token = token.decode("ascii")
+        if token[0] == "W":
+            header['width'] = int(token[1:])
+        elif token[0] == "H":
+            header['height'] = int(token[1:])
+        elif token[0] == "F":
+            (num, den) = token[1:].split(":")
+            header['frame_rate'] = (int(num), int(den))
+        elif token[0] == "C":
+            match = re.match(
+                r"(?:(mono)(\d*)|(444alpha)|(\d{3})(?:p(\d+))?)", token[1:])
+            if match is None or (match.group(4) is not None
+                                 and match.group(4) not in chroma_formats):
+                raise ValueError("Unsupported YUV4MPEG2 colorspace " + token)
+            header['chroma'] = match.group(1) or match.group(3) or \
+                match.group(4)
+            depth = match.group(2) or match.group(5)
+            if depth:
+                header['bit_depth'] = int(depth)
+    if 'width' not in header or 'height' not in header:
+        raise ValueError("YUV4MPEG2 header without frame size")
+    return header
+
+
+# Size in bytes of the payload of a frame, without its FRAME line
+def frame_size(header):
+    width = header['width']
+    height = header['height']
+    chroma_width = (width + 1) // 2
+    chroma_height = (height + 1) // 2
+    samples = {
+        "mono": width * height,
+        "420": width * height + 2 * chroma_width * chroma_height,
+        "422": width * height + 2 * chroma_width * height,
+        "444": 3 * width * height,
+        "444alpha": 4 * width * height
+    }[header['chroma']]
+    if header['bit_depth'] > 8:
+        return samples * 2
+    return samples
+
+
+# Reads the stream header and the frame layout of a Y4M file, without
+# decoding it. Returns the parsed header with the frame count and the sizes
+# needed to locate the frames: header_size, frame_header_size (None when the
+# FRAME lines do not all have the same length) and frame_size.
+def probe(path):
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header_line = f.readline()
+        header = parse_header(header_line)
+        size = frame_size(header)
+        header['header_size'] = len(header_line)
+        header['frame_size'] = size
+
+        frame_line = f.readline()
+        if not frame_line:
+            header['frame_header_size'] = len(frame_signature) + 1
+            header['frames'] = 0
+            return header
+        if not frame_line.startswith(frame_signature):
+            raise ValueError("Corrupted YUV4MPEG2 stream: " + path)
+
+        # Usual case, every frame starts with the same FRAME line
+        stride = len(frame_line) + size
+        if (file_size - len(header_line)) % stride == 0:
+            header['frame_header_size'] = len(frame_line)
+            header['frames'] = (file_size - len(header_line)) // stride
+            return header
+
+        # Otherwise, seek from one frame header to the next
+        frames = 0
+        offset = len(header_line)
+        while frame_line:
+            if not frame_line.startswith(frame_signature):
+                raise ValueError("Corrupted YUV4MPEG2 stream: " + path)
+            offset += len(frame_line) + size
+            if offset > file_size:
+                raise ValueError("Truncated YUV4MPEG2 stream: " + path)
+            frames += 1
+            f.seek(offset)
+            frame_line = f.readline()
+        header['frame_header_size'] = None
+        header['frames'] = frames
+        return header
+
+
+# Offsets of the frame payloads, past their FRAME line
+def frame_offsets(path, header):
+    if header['frame_header_size'] is not None:
+        stride = header['frame_header_size'] + header['frame_size']
+        return [
+            header['header_size'] + header['frame_header_size'] + i * stride
+            for i in range(header['frames'])
+        ]
+
+    offsets = []
+    with open(path, "rb") as f:
+        offset = header['header_size']
+        for i in range(header['frames']):
+            f.seek(offset)
+            offset += len(f.readline())
+            offsets.append(offset)
+            offset += header['frame_size']
+    return offsets
+
+
+# Returns the luma planes of a Y4M file as a (frames, height, width) array
+# mapped from the file without copying it, with 16 bits little-endian
+# samples for depths above 8 bits.
+def luma_planes(path, header=None):
+    if header is None:
+        header = probe(path)
+    if header['bit_depth'] > 8:
+        dtype = np.dtype("<u2")
+    else:
+        dtype = np.dtype("u1")
+    shape = (header['height'], header['width'])
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+
+    if header['frame_header_size'] is not None:
+        stride = header['frame_header_size'] + header['frame_size']
+        return np.ndarray(
+            (header['frames'], ) + shape,
+            dtype=dtype,
+            buffer=data,
+            offset=header['header_size'] + header['frame_header_size'],
+            strides=(stride, shape[1] * dtype.itemsize, dtype.itemsize))
+
+    # FRAME lines of different lengths, the planes cannot be a single view
+    return np.stack([
+        np.ndarray(shape, dtype=dtype, buffer=data, offset=offset)
+        for offset in frame_offsets(path, header)
+    ])
+
+
+# Copies count bytes of in_fd from offset to the position of out_fd, in the
+# kernel when possible
+def copy_range(in_fd, out_fd, offset, count):
+    while count > 0:
+        try:
+            sent = os.sendfile(out_fd, in_fd, offset, count)
+        except (AttributeError, OSError):
+            # No sendfile between regular files on this system
+            sent = os.write(out_fd, os.pread(in_fd, min(count, 1 << 24),
+                                             offset))
+        if sent == 0:
+            raise ValueError("Truncated YUV4MPEG2 stream")
+        offset += sent
+        count -= sent
+
+
+# Writes the frames of the given indexes of a Y4M file to every output, a
+# list of (path, raw) tuples: a Y4M file, or only the frame payloads when
+# raw. The payloads are copied without going through user space.
+def extract_frames(path, indexes, outputs, header=None):
+    if header is None:
+        header = probe(path)
+    offsets = frame_offsets(path, header)
+    fds = []
+    with open(path, "rb") as src:
+        header_line = src.readline()
+        try:
+            for (output, raw) in outputs:
+                fds.append((os.open(output,
+                                    os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                    0o644), raw))
+                if not raw:
+                    os.write(fds[-1][0], header_line)
+            for i in indexes:
+                for (fd, raw) in fds:
+                    if not raw:
+                        os.write(fd, frame_signature + b"\n")
+                    copy_range(src.fileno(), fd, offsets[i],
+                               header['frame_size'])
+        finally:
+            for (fd, raw) in fds:
+                os.close(fd)
+
+
+# Writes the frame payloads of a Y4M file to a raw YUV file
+def to_raw(path, output, header=None):
+    if header is None:
+        header = probe(path)
+    extract_frames(path, range(header['frames']), [(output, True)], header)